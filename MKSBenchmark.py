@@ -0,0 +1,215 @@
+#=============================================================================
+#
+# file :        MKSBenchmark.py
+#
+# description : Throughput and latency benchmarks for MKSGaugeController,
+#                using MKSSimulator instead of real hardware.
+#
+#                  python MKSBenchmark.py [--save results.json]
+#                  python MKSBenchmark.py --baseline results.json --tolerance 0.2
+#
+#                With --device the benchmarks are also run through Tango
+#                against a running MKSGaugeController connected to the
+#                simulator port (--port), e.g. with Transport=tcp://localhost:4001
+#
+# project :    VacuumController Device Server
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import sys,time,json,threading
+
+import MKSProtocol
+from MKSProtocol import classifyReply,parseReply,percentile
+from MKSSimulator import MKS937ASimulator,MKSLineSimulator
+from MKSTransport import openTransport
+from MKSSerialDevice import MKSSerialDevice
+
+#Commands polled at Refresh period by MKSGaugeController, and slow ones
+FAST_COMMANDS = ['P1','P2','P4','P5']
+SLOW_COMMANDS = ['GAUGES','P3','C1','C2','PRO1','PRO2']+['RLY%d'%i for i in range(1,6)]+['RELAYS','VER']
+
+def timeit(method,n):
+    """ Returns the average time in seconds of n calls to method """
+    t0 = time.time()
+    for i in range(n): method()
+    return (time.time()-t0)/n
+
+def benchClassifier(n=20000):
+    """ Reply parsing cost, with and without cache hits """
+    line = MKSLineSimulator()
+    replies = [line.serialComm('P%d'%(1+i%5)) for i in range(5)]
+    replies += ['%1.2E'%(1e-9*(1+i%997)) for i in range(n)]
+    it = iter(replies*2)
+    MKSProtocol._cache.clear()
+    return {
+        'parse_us':1e6*timeit(lambda:parseReply(next(it)),n),
+        'classify_cached_us':1e6*timeit(lambda:classifyReply(replies[0]),n),
+        }
+
+def pollLine(line,period,duration,bulk=None):
+    """
+    Polls line for duration seconds with a MKSSerialDevice and the process PollScheduler,
+    registering the commands as MKSGaugeController does: fast channels at period, slow ones at period*20.
+    With bulk the channels are read with the bulk command, as done with the BulkCommand property.
+    """
+    owner = 'benchmark'
+    bus = MKSSerialDevice('simulator',transport=line,log='WARNING')
+    if bulk:
+        channels = [('$0P%d'%i,period if 'P%d'%i in FAST_COMMANDS else period*20) for i in range(1,6)]
+        bus.setBulkComm('$0'+bulk,channels,period,owner=owner)
+    else:
+        [bus.setPolledComm('$0'+c,period,owner=owner) for c in FAST_COMMANDS]
+    [bus.setPolledComm('$0'+c,period*20,owner=owner) for c in SLOW_COMMANDS if not bulk or c!='P3']
+    #Replies are classified by the listener, as done by the device
+    bus.addListener(owner,lambda comm,reply,timestamp:classifyReply(reply))
+    bus.start()
+    try:
+        time.sleep(duration)
+    finally:
+        bus.stop()
+    return bus
+
+def benchPollCycle(latency=.02,duration=2.,bulk='PZ'):
+    """
+    Polling through MKSSerialDevice and the PollScheduler against the simulator:
+    time to read all the fast channels with the line saturated, per channel commands and bulk;
+    jitter (95 percentile) of P1 polled at a period the line can sustain;
+    and cost of each polled command on a line without latency.
+    """
+    results = {}
+    for mode in ('channels','bulk'):
+        line = MKSLineSimulator({0:MKS937ASimulator(bulk=bulk)},latency=latency)
+        pollLine(line,latency,duration,bulk if mode=='bulk' else None)
+        periods = line.getPeriods('$0'+(bulk if mode=='bulk' else FAST_COMMANDS[0]))
+        results['cycle_%s_s'%mode] = sum(periods)/len(periods)
+    period = 4*latency*len(FAST_COMMANDS)
+    line = MKSLineSimulator(latency=latency)
+    bus = pollLine(line,period,max(duration,10*period))
+    results['jitter_p95_s'] = percentile([abs(p-period) for p in line.getPeriods('$0P1')],95)
+    results['missed_deadlines'] = sum(s['missed'] for s in bus.getCommStats('benchmark').values())
+    line = MKSLineSimulator()
+    pollLine(line,.001,duration/2.)
+    results['poll_comm_us'] = 1e6*(duration/2.)/len(line.log)
+    return results
+
+def benchReadPath(n=20000):
+    """ Cost of serving a cached channel reading from the bus, as done by the attribute readers """
+    results,owner = {},'benchmark'
+    for mode in ('channels','bulk'):
+        bus = MKSSerialDevice('simulator',transport=MKSLineSimulator({0:MKS937ASimulator(bulk='PZ')}),log='WARNING')
+        if mode=='bulk':
+            bus.setBulkComm('$0PZ',[('$0P%d'%i,1.) for i in range(1,6)],1.,owner=owner)
+            bus.pollComm('$0PZ',owner)
+        else:
+            bus.setPolledComm('$0P1',1.,owner=owner)
+            bus.pollComm('$0P1',owner)
+        results['read_%s_us'%mode] = 1e6*timeit(lambda:classifyReply(bus.getComm('$0P1')).value,n)
+    return results
+
+def benchTransport(port,n=500):
+    """ Round trip of a command through a direct TCP transport to the simulator, compared with an in-process call """
+    line = MKSLineSimulator()
+    server = line.serve(port)
+    threading.Thread(target=server.serve_forever).start()
+    transport = openTransport('tcp://localhost:%d'%port)
+    try:
+        transport.serialComm('$0P1') #connecting
+        return {
+            'comm_inprocess_us':1e6*timeit(lambda:line.serialComm('$0P1'),n),
+            'comm_tcp_us':1e6*timeit(lambda:transport.serialComm('$0P1'),n),
+            }
+    finally:
+        transport.close()
+        server.shutdown()
+        server.server_close()
+
+def benchDevice(device,port,n=100,timeout=30.):
+    """
+    Runs the simulator at port and measures a running MKSGaugeController connected to it:
+    attribute read latency, hook cost (SerialLine read does not access the hardware),
+    state change latency when the CC is switched off and achieved polling period.
+    """
+    import PyTango
+    controller = MKS937ASimulator()
+    line = MKSLineSimulator({0:controller})
+    server = line.serve(port)
+    threading.Thread(target=server.serve_forever).start()
+    try:
+        dp = PyTango.DeviceProxy(device)
+        t0 = time.time()
+        while dp.state()!=PyTango.DevState.ON and time.time()<t0+timeout:
+            time.sleep(.1)
+        results = {'startup_s':time.time()-t0}
+        for attr in ('P1','PressureValues','ChannelState','SerialLine'):
+            results['read_%s_ms'%attr] = 1e3*timeit(lambda:dp.read_attribute(attr),n)
+        controller.hv[1] = False #P1 replies HV_OFF
+        t0 = time.time()
+        while dp.state()!=PyTango.DevState.OFF and time.time()<t0+timeout:
+            time.sleep(.01)
+        results['state_change_s'] = time.time()-t0
+        periods = line.getPeriods('$0P1') or line.getPeriods('P1')
+        if periods:
+            results['poll_period_P1_s'] = sum(periods)/len(periods)
+        return results
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def compare(results,baseline,tolerance=.2):
+    """ Returns the list of metrics that are worse than baseline by more than tolerance """
+    #All the metrics are times or counts, the lower the better
+    return ['%s: %g > %g'%(k,v,baseline[k]) for k,v in sorted(results.items())
+        if baseline.get(k) and v>baseline[k]*(1+tolerance)]
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='MKSGaugeController benchmarks')
+    parser.add_argument('--latency',type=float,default=.02,help='simulated serial latency')
+    parser.add_argument('--duration',type=float,default=2.,help='seconds of polling for each measurement')
+    parser.add_argument('--device',default=None,help='MKSGaugeController device to benchmark')
+    parser.add_argument('--port',type=int,default=4001,help='simulator port used by --device')
+    parser.add_argument('--save',default=None,help='file to store results')
+    parser.add_argument('--baseline',default=None,help='results file to compare with')
+    parser.add_argument('--tolerance',type=float,default=.2)
+    args = parser.parse_args(args)
+
+    results = {}
+    results.update(benchClassifier())
+    results.update(benchReadPath())
+    results.update(benchPollCycle(args.latency,args.duration))
+    results.update(benchTransport(args.port))
+    if args.device:
+        results.update(benchDevice(args.device,args.port))
+
+    for k,v in sorted(results.items()):
+        print('%-28s %12.6f'%(k,v))
+    if args.save:
+        json.dump(results,open(args.save,'w'),indent=2,sort_keys=True)
+    if args.baseline:
+        regressions = compare(results,json.load(open(args.baseline)),args.tolerance)
+        for r in regressions: print('REGRESSION: %s'%r)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -53,8 +53,9 @@
 ##########################################################################
 #
 
-import sys,time,re
-from threading import Event
+import sys,os,time,re,json
+IMPORT_STARTED = time.time()
+from threading import Event,RLock
 import traceback
 
 import PyTango
@@ -63,18 +64,16 @@ from PyTango import DevState,AttrQuality,DevFailed
 import fandango
 
 from fandango.device import Dev4Tango,TimedQueue
-from fandango.excepts import ExceptionWrapper,Catched,Catched2
 from fandango.objects import self_locked
 import fandango.functional as fun
 
-import VacuumController
-try:
-    #suse
-    from VacuumController import getExpNumbers
-except:
-    #debian
-    from VacuumController.SerialVacuumDevice import getExpNumbers
-from VacuumController import *
+#VacuumController (through MKSSerialDevice) and fandango.excepts are imported
+#when first needed, so the server registers its classes sooner
+import MKSProtocol
+from MKSProtocol import classifyReply,parseThresholds,isChange,adaptivePeriod,isValidSetting,isValidReply,Sample,Snapshot
+from MKSProtocol import combinationPairs,combineReadings,channelTable,describeModules,moduleChannels,DEFAULT_CROSSOVER
+from MKSHistory import PressureHistory,MissreadingsLog,MissreadingsFilter
+IMPORT_TIME = time.time()-IMPORT_STARTED
 
 ## @note Backward compatibility between PyTango3 and PyTango7
 if 'PyDeviceClass' not in dir(PyTango): PyTango.PyDeviceClass = PyTango.DeviceClass
@@ -119,14 +118,8 @@ class MKSGaugeController(Dev4Tango):
     #State Machine methods
     def is_Attr_allowed(self, req_type): 
         self.debug( 'In is_Attr_allowed ...')
-        return bool(self.SVD and self.SVD.errors<len(self.SVD.readList) and  self.get_state() not in [PyTango.DevState.UNKNOWN] and self.SVD.init)#,PyTango.DevState.INIT] )
-    is_P1_allowed=is_Attr_allowed
-    is_P2_allowed=is_Attr_allowed
-    is_P3_allowed=is_Attr_allowed
-    is_P4_allowed=is_Attr_allowed
-    is_P5_allowed=is_Attr_allowed
-    is_C1_allowed=is_Attr_allowed
-    is_C2_allowed=is_Attr_allowed
+        owner = self.get_name()
+        return bool(self.SVD and self.SVD.getErrors(owner)<len(self.SVD.getComms(owner)) and  self.get_state() not in [PyTango.DevState.UNKNOWN] and self.SVD.isInit(owner,self.EssentialComms))#,PyTango.DevState.INIT] )
     is_ChannelState_allowed=is_Attr_allowed
     is_ChannelValue_allowed=is_Attr_allowed
     is_CombinationChannelState_allowed=is_Attr_allowed
@@ -135,9 +128,10 @@ class MKSGaugeController(Dev4Tango):
     is_ModulesInstalled_allowed=is_Attr_allowed
     is_PressureValues_allowed=is_Attr_allowed
     
-    FLOAT = '[0-9](\.[0-9]{1,2})?[eE][+-][0-9]{2,2}$'
-    ERROR_CODES = ['PROTECT','HV_OFF','NOGAUGE','MISCONN','LO']
-    VALID_CODES = [FLOAT,'HI>','LO','AA_','WAIT','([A-Za-z]+)([ _]?)([A-Z]*)!$']+ERROR_CODES
+    FLOAT = MKSProtocol.FLOAT
+    ERROR_CODES = MKSProtocol.ERROR_CODES
+    VALID_CODES = MKSProtocol.VALID_CODES
+    QUALITIES = dict((q,getattr(AttrQuality,'ATTR_'+q)) for q in MKSProtocol.QUALITIES)
        
     def WarmUp(self):
         funcs = {}
@@ -168,65 +162,219 @@ class MKSGaugeController(Dev4Tango):
         return '\n'.join(self.StartSequence)
             
     def read_modules(self):
-        self.piranis,self.modules = [],self.SVD.getComm(self.CommPrefix+'GAUGES')
-        if self.modules[0:2] in ('Cv','Pr'): self.piranis.extend(['P1','P2'])
-        if self.modules[2:4] in ('Cv','Pr'): self.piranis.extend(['P2','P3'])
-        if self.modules[4:6] in ('Cv','Pr'): self.piranis.extend(['P4','P5'])
+        self.modules = self.SVD.getComm(self.CommPrefix+'GAUGES')
+        #Same module table used for the combination channels, see MKSProtocol.MODULES
+        self.piranis = moduleChannels(self.modules)['PIRANI']
         #self.info('Piranis allocated in ports: %s'%self.piranis)
         return self.modules
 
     def read_Pressure_channel(self,attr,c_type,nchan):
         c_name=c_type+str(nchan)
-        if c_type=='P':
-            self.ChannelState[c_name] = 'Unknown'
-        result=self.SVD.getComm(self.CommPrefix+c_type+str(nchan))
+        #The snapshot is replaced (never modified) by the polling thread, no lock is needed
+        sample = self.snapshot.samples.get(c_name)
+        if c_type=='C' and self.LocalCombination:
+            sample = self.getCombination(c_name)
+        if sample is None:
+            result=self.SVD.getComm(self.CommPrefix+c_name)
+            sample = Sample(classifyReply(result),time.time())
+        reading = sample.reading
         
-        self.debug(c_type+str(nchan)+' returned: '+str(result))
+        self.debug(c_name+' returned: '+str(reading.raw))
 
-        #@TODO: ChannelState should be unknown only after N missreadings 
-        #... do not erase last reading just because 1 error!
+        #Single missreadings are filtered by the polling thread, see filterReading
         
         #if self.get_state()!=DevState.ON: PyTango.Except.throw_exception('MKS_NotAllowed','Attribute reading is not allowed in this State','MKSGaugeController.read_Pressure_channel(...)')            
-        if result is None or not len(result) or not any([re.match(exp,result) for exp in self.VALID_CODES]):
-            if result and hasattr(self,'manageMissreadings'): 
-                self.manageMissreadings(value=result)
-                print 'Missreadings are '+str(self.missreadings)
-            PyTango.Except.throw_exception('MKS_CommFailed','Hardware failed or not read yet','MKSGaugeController.read_Pressure_channel(...)=%s'%(result or ''))
+        if reading.kind=='INVALID':
+            PyTango.Except.throw_exception('MKS_CommFailed','Hardware failed or not read yet','MKSGaugeController.read_Pressure_channel(...)=%s'%(reading.raw or ''))
 
-        try:
-            quality = AttrQuality.ATTR_VALID
-            if 'LO' in result or 'OFF' in result:
-                quality = AttrQuality.ATTR_WARNING
-                attr_Px_read = 0
-            elif 'PRO' in result:
-                quality = AttrQuality.ATTR_ALARM
-                attr_Px_read = 1
-            else:
-                if any([ (code in result) for code in self.ERROR_CODES]): raise Exception, 'MKS_Channel%sNotOk_%s'%(nchan,result)
-                N = getExpNumbers(result)
-                if N is not None:
-                    attr_Px_read = float(getExpNumbers(result)[0])#float(result)
-                    if '+' not in result and not 0<attr_Px_read<1:
-                        if hasattr(self,'manageMissreadigns'): self.manageMissreadings(value=result)
-                        else: raise Exception, 'MKS_WrongReading_%s'%result
-                else: raise Exception, 'MKS_WrongReading_CHECK_%s'%result
-        except Exception,e: 
-            if c_type=='P':
-                self.PreviousValues[nchan-1] = self.PressureValues[nchan-1]
-                self.PressureValues[nchan-1] = 0.0
-                self.ChannelState[c_name]=result
-            print 'Exception in read_Pressure_channel: %s' %  ('MKS' in str(e) and str(e) or traceback.format_exc())
-            PyTango.Except.throw_exception(str(e),'ChannelState='+str(result),'MKSGaugeController.read_Pressure_channel('+c_type+str(nchan)+')')
+        if reading.value is None:
+            e = 'MKS_Channel%sNotOk_%s'%(nchan,reading.raw)
+            print 'Exception in read_Pressure_channel: %s'%e
+            PyTango.Except.throw_exception(e,'ChannelState='+str(reading.raw),'MKSGaugeController.read_Pressure_channel('+c_name+')')
         
-        #PressureValues is updated only when everything is OK
-        if c_type=='P':
-            self.PreviousValues[nchan-1] = self.PressureValues[nchan-1]
-            self.PressureValues[nchan-1] = attr_Px_read
-            self.ChannelState[c_name] = result #'%1.1e'%attr_Px_read#'OK'
-        attr.set_value(attr_Px_read)
-        attr.set_quality(quality)
-        self.info('read_Pressure_channel(%s): %s,%s'%(c_name,attr_Px_read,quality))
-        #attr.set_quality(PyTango.AttrQuality.VALID)
+        attr_Px_read,quality = reading.value,self.QUALITIES[reading.quality]
+        attr.set_value_date_quality(attr_Px_read,sample.timestamp,quality)
+        self.debug('read_Pressure_channel(%s): %s,%s'%(c_name,attr_Px_read,quality))
+
+    def getCombination(self,c_name):
+        """ Returns the Sample of a combination channel computed from the last cold cathode and Pirani samples """
+        samples = self.snapshot.samples
+        gauges = samples['GAUGES'].reading.raw if 'GAUGES' in samples else self.SVD.getComm(self.CommPrefix+'GAUGES')
+        pair = combinationPairs(gauges).get(c_name)
+        if pair is None:
+            PyTango.Except.throw_exception('MKS_NoCombination','%s requires a cold cathode and a Pirani module'%c_name,'MKSGaugeController.getCombination(%s)'%gauges)
+        ccg,pirani = samples.get(pair[0]),samples.get(pair[1])
+        #The protect setpoint of the cold cathode is used as crossover
+        setpoint = samples.get('PRO'+c_name[1:])
+        crossover = setpoint.reading.value if setpoint and setpoint.reading.kind=='FLOAT' else DEFAULT_CROSSOVER
+        reading = combineReadings(ccg and ccg.reading,pirani and pirani.reading,crossover)
+        return Sample(reading,max(s.timestamp for s in (ccg,pirani) if s) if ccg or pirani else time.time())
+
+    def addChannelAttributes(self,channels):
+        """ Creates the attributes of the channels table, removing the ones created for a previous table """
+        for name in getattr(self,'channelAttributes',[]):
+            if name not in channels:
+                self.remove_attribute(name)
+        for name in channels:
+            if name in getattr(self,'channelAttributes',[]): continue
+            attr = PyTango.Attr(name,PyTango.DevDouble,PyTango.AttrWriteType.READ)
+            props = PyTango.UserDefaultAttrProp()
+            props.set_unit('mbar')
+            props.set_format('%5.2e')
+            if name.startswith('C'):
+                props.set_description('Combination of a cold cathode with its Pirani, see CombinationChannels property')
+            attr.set_default_properties(props)
+            self.add_attribute(attr,MKSGaugeController.read_Channel,None,MKSGaugeController.is_Attr_allowed)
+        self.channelAttributes = list(channels)
+
+    def processReply(self,comm,reply,timestamp):
+        """
+        Called from the polling thread for every new reply of this device commands.
+        Channel replies are classified once and the Reading used for snapshot, history, events and polling.
+        """
+        self.startupMark('first reply')
+        command = comm[len(self.CommPrefix):]
+        #The snapshot is also updated by expireReadings, from the Tango threads
+        with self.snapshotLock:
+            if command in MKSProtocol.SETTINGS:
+                if self.CachePath: self.updateCache(command,reply)
+                #Settings are also published, so GetSnapshot returns them from the same generation
+                self.publishSnapshot(command,Sample(classifyReply(reply),timestamp))
+            if command in self.Channels:
+                reading = classifyReply(reply)
+                if reading.kind=='INVALID' and reply:
+                    self.manageMissreadings(value=reply,channel=command)
+                sample = self.filterReading(command,reading,timestamp)
+                self.publishSnapshot(command,sample)
+                self.updateHistory(command,reading,timestamp)
+                self.pushEvents(command,sample.reading,timestamp)
+                if self.AdaptivePolling and comm not in self.SVD.bulkChannels:
+                    self.updatePollingPeriod(command,reading,timestamp)
+        #Readings of other channels held for too long
+        self.expireReadings(timestamp)
+
+    def filterReading(self,channel,reading,timestamp):
+        """
+        Failed readings are replaced by the last good Sample of the channel until
+        MissreadingsTolerance consecutive failures or MissreadingsTimeout seconds since the first of them;
+        once the polling is suspended (see MKSSerialDevice.notifyFailure) failures are published at once.
+        """
+        good = self.snapshot.samples.get(channel)
+        sample = self.readingFilter.filter(channel,reading,timestamp,good,self.SVD.isOpen(self.get_name()))
+        if sample is good:
+            self.debug('%s: %s ignored'%(channel,reading.raw))
+        return sample
+
+    def expireReadings(self,now=None):
+        """ Publishes the failed readings of channels held by filterReading for more than MissreadingsTimeout """
+        with self.snapshotLock:
+            for channel,sample in self.readingFilter.expire(self.snapshot.samples,now).items():
+                self.info('%s: no valid reading since MissreadingsTimeout, %s published'%(channel,sample.reading.raw))
+                self.publishSnapshot(channel,sample)
+                self.pushEvents(channel,sample.reading,sample.timestamp)
+
+    def getMemo(self,name,method):
+        """ Returns method(), computed once per poll generation and shared by all the readers """
+        key = (self.snapshot.generation,self.SVD.getGeneration(self.get_name()) if self.SVD else None)
+        memo = self.memo.get(name)
+        if memo is None or memo[0]!=key:
+            memo = self.memo[name] = (key,method())
+        return memo[1]
+
+    def publishSnapshot(self,channel,sample):
+        """ Publishes a new snapshot of channel readings, the previous one is left untouched """
+        snapshot = self.snapshot
+        samples = dict(snapshot.samples)
+        samples[channel] = sample
+        if channel in self.Channels:
+            self.ChannelState = dict((k,s.reading.raw or 'Unknown') for k,s in samples.items() if k in self.Channels)
+            self.PressureValues = [samples[k].reading.value if k in samples and samples[k].reading.kind=='FLOAT' else 0.0
+                for k in self.Channels]
+        self.snapshot = snapshot = Snapshot(snapshot.generation+1,max(snapshot.timestamp,sample.timestamp),samples)
+        if self.sharedMemory is not None and channel in self.Channels:
+            self.sharedMemory.write(*snapshot)
+
+    def pushEvents(self,channel,reading,timestamp):
+        """ Pushes change/archive events when thresholds are exceeded """
+        if not isChange(self.LastReadings[channel],reading,*self.thresholds.get(channel,self.thresholds['*'])):
+            return
+        self.LastReadings[channel] = reading
+        self.pushEvent(channel,reading.value or 0.,timestamp,self.QUALITIES[reading.quality])
+        #Arrays are pushed as read by the clients, from the snapshot just published
+        self.pushEvent('PressureValues',self.PressureValues,timestamp)
+        self.pushEvent('ChannelState',self.read_ChannelState(),timestamp)
+
+    def updatePollingPeriod(self,channel,reading,timestamp):
+        """ Slows down idle channels and speeds up the changing ones """
+        if channel not in self.ChannelPeriods: return
+        previous = self.PollReadings.get(channel)
+        self.PollReadings[channel] = reading
+        #PRO1 protects the CC in P1, PRO2 the second CC
+        setpoint = None
+        if channel not in self.piranis:
+            setpoint = classifyReply(self.SVD.getComm(self.CommPrefix+('PRO1' if channel=='P1' else 'PRO2'))).value
+        base = self.ChannelPeriods[channel]
+        period = adaptivePeriod(reading,previous,base,base*self.AdaptivePolling,setpoint)
+        comm = self.CommPrefix+channel
+        if period!=self.SVD.getPeriod(comm):
+            self.debug('%s polling period set to %s (%s)'%(channel,period,reading.kind))
+            self.SVD.setPolledComm(comm,period,owner=self.get_name())
+
+    def updateHistory(self,channel,reading,timestamp):
+        """ Stores every channel sample in its ring buffer """
+        #LO/OFF/PROTECT values are placeholders, not pressures; stored as None (NaN) with their quality
+        value = reading.value if reading.kind in ('FLOAT','HI') else None
+        self.History[channel].append(timestamp,value,reading.quality)
+        #Noise is evaluated once per sample, on a fixed number of samples
+        samples,spike = self.OscillationThresholds[:2]
+        noise = self.History[channel].noise(int(samples),spike)
+        if noise!=self.Noise.get(channel):
+            self.Noise[channel] = noise
+            self.noiseGeneration+=1 #Noise is used by the StateMachine
+
+    def getCacheFile(self):
+        return os.path.join(self.CachePath,self.get_name().replace('/','_')+'.json') if self.CachePath else ''
+
+    def loadCache(self):
+        """ Slow-changing settings saved by a previous run are served (as stale) until revalidated """
+        try:
+            cache = json.load(open(self.getCacheFile()))
+        except Exception,e:
+            self.info('No cached settings loaded: %s'%e)
+            return {}
+        cache = dict((k,str(v)) for k,v in cache.items() if k in MKSProtocol.SETTINGS and isValidSetting(k,v))
+        timestamp = os.path.getmtime(self.getCacheFile())
+        for k,v in cache.items():
+            self.SVD.preloadComm(self.CommPrefix+k,v)
+            #Published too, so GetSnapshot returns the same values than the attributes
+            self.publishSnapshot(k,Sample(classifyReply(v),timestamp))
+        self.info('Cached settings loaded: %s'%cache)
+        return cache
+
+    def updateCache(self,command,reply):
+        """ Saves settings to CachePath when they change """
+        if self.WarmCache.get(command)==reply or not isValidSetting(command,reply):
+            return
+        self.WarmCache[command] = reply
+        try:
+            filename = self.getCacheFile()
+            if not os.path.isdir(self.CachePath): os.makedirs(self.CachePath)
+            json.dump(self.WarmCache,open(filename+'.tmp','w'))
+            os.rename(filename+'.tmp',filename)
+        except Exception,e:
+            self.warning('Unable to save settings cache: %s'%e)
+
+    def resetPollingPeriod(self,channel):
+        """ Channel is polled at its default period, starting now """
+        if channel in self.ChannelPeriods:
+            self.SVD.setPolledComm(self.CommPrefix+channel,self.ChannelPeriods[channel],time.time(),owner=self.get_name())
+
+    def pushEvent(self,attribute,value,timestamp,quality=AttrQuality.ATTR_VALID):
+        try:
+            self.push_change_event(attribute,value,timestamp,quality)
+            self.push_archive_event(attribute,value,timestamp,quality)
+        except Exception,e:
+            self.warning('pushEvent(%s) failed: %s'%(attribute,e))
         
     def StateMachine(self,prev=None):
         """ This method manages the StateMachine of the MKSGaugeController 
@@ -247,19 +395,25 @@ class MKSGaugeController(Dev4Tango):
         self.debug('In StateMachine() ...')
         state = prev is not None and prev or self.get_state()
         prev,channelstatus=state,''
-        now = time.time()
+        now,owner = time.time(),self.get_name()
         
         #Checking Communications status
-        if not self.SerialLine or not self.SVD: #Checking if serial line is initialized
+        if not self.SVD: #Checking if serial line is initialized
             state,channelstatus = DevState.FAULT,'SerialLine property requires a value!'
-        elif not self.SVD.init: #If done in 2 lines to avoid changing to ON by default
+        elif self.SVD.isOpen(owner): #Not polled after consecutive failures, retried with increasing periods
+            self.debug('State is UNKNOWN, polling suspended')
+            state = DevState.UNKNOWN
+            channelstatus = 'Unable to communicate since %s, next retry at %s'%(
+                time.ctime(self.SVD.getLastTime(owner)),time.ctime(self.SVD.getProbeTime(owner)))
+            self.ChannelState = dict((k,'Unknown') for k in self.ChannelState)
+        elif not self.SVD.isInit(owner,self.EssentialComms): #If done in 2 lines to avoid changing to ON by default
             self.debug('State is INIT')
             state,channelstatus = DevState.INIT,'Hardware values not read yet, started at %s'%time.ctime(self.startTime)
-        elif self.SVD.errors>=len(self.SVD.readList) or self.SVD.lasttime<now-2*60:
+        elif self.SVD.getErrors(owner)>=len(self.SVD.getComms(owner)) or self.SVD.getLastTime(owner)<now-2*60:
             self.debug('State is UNKNOWN or FAULT')
-            state = self.SVD.errors and DevState.UNKNOWN or DevState.FAULT
-            channelstatus = 'Unable to communicate since %s'%time.ctime(self.SVD.lasttime)
-            for k in self.ChannelState.keys(): self.ChannelState[k]='Unknown'
+            state = self.SVD.getErrors(owner) and DevState.UNKNOWN or DevState.FAULT
+            channelstatus = 'Unable to communicate since %s'%time.ctime(self.SVD.getLastTime(owner))
+            self.ChannelState = dict((k,'Unknown') for k in self.ChannelState)
         #Checking Channel state through ChannelState and ModulesInstalled
         else:
             self.debug('State is ON-relative')
@@ -269,17 +423,20 @@ class MKSGaugeController(Dev4Tango):
                 self.info(channelstatus)
                 state=DevState.FAULT
             else:
+                #Replies are classified once, kinds are FLOAT/LO/OFF/HI/PROTECT/...
+                kinds = dict((k,classifyReply(s).kind) for k,s in self.ChannelState.items())
                 ccg_states = [s.lower() for k,s in self.ChannelState.items() if k not in self.piranis]
-                pir_states = [s.lower() for k,s in self.ChannelState.items() if k in self.piranis]
+                ccg_kinds = [s for k,s in kinds.items() if k not in self.piranis]
+                pir_kinds = [s for k,s in kinds.items() if k in self.piranis]
                 #Check Protect
-                if any(m in s.lower() for m in ('pro','hi') for s in self.ChannelState.values()):
+                if any(s in ('PROTECT','HI') for s in kinds.values()):
                     channelstatus+='Channel readings above range!\n'
                     state=DevState.ALARM
                 #If any channel is ON, state in ON/MOVING/ALARM
-                elif any(re.match(reg,s) for reg in ('ok',self.FLOAT,'lo') for s in ccg_states):
+                elif any(s in ('FLOAT','LO') for s in ccg_kinds):
                     state=DevState.ON
                     #Check Default Status (or just first channel if not defined)
-                    if any(re.match('lo',s) for s in ccg_states):
+                    if 'LO' in ccg_kinds:
                             channelstatus+='Channel readings below range!: %s\n'%str(ccg_states)
                             state=DevState.MOVING
                     for i,s in enumerate(self.DefaultStatus.split(',') or ['']):
@@ -288,22 +445,31 @@ class MKSGaugeController(Dev4Tango):
                             state=DevState.ALARM
                     if state in (DevState.ON,DevState.MOVING):
                         #Check Piranis
-                        if  any(re.match(self.FLOAT,s) for s in pir_states):
-                            if any(re.match(self.FLOAT,s) for s in ccg_states):
+                        if 'FLOAT' in pir_kinds:
+                            if 'FLOAT' in ccg_kinds:
                                 state=DevState.MOVING #Both Pirani and CCG have readings
                             else:
                                 state=DevState.ALARM #CCG out of range, reading Pirani
                             channelstatus+="Pirani has readings!\n"
                         else:
                             channelstatus+='Controller is working properly.\n'
-                        #Check oscillation
-                        for old,new in zip(self.PreviousValues,self.PressureValues):
-                            if old and new and not (.5<(old/new)<1.5): 
+                        #Check oscillation and drift, Noise is updated by the polling thread
+                        spikes,drift,variance = self.OscillationThresholds[2],self.OscillationThresholds[3]/60.,self.OscillationThresholds[4]
+                        for k,n in sorted(self.Noise.items()):
+                            if n.spikes>=spikes: 
+                                state=DevState.MOVING                
+                                channelstatus+="Gauge %s oscillates (%d spikes)!\n" % (k,n.spikes)
+                                break
+                            elif abs(n.slope)>drift:
                                 state=DevState.MOVING                
-                                channelstatus+="Gauge oscillates between %s and %s!\n" % (old,new)
+                                channelstatus+="Gauge %s is drifting (%1.1f decades/min)!\n" % (k,60*n.slope)
+                                break
+                            elif variance and n.variance>variance:
+                                state=DevState.MOVING
+                                channelstatus+="Gauge %s is noisy (%1.2f decades rms)!\n" % (k,n.variance**.5)
                                 break
                 #If everything is OFF
-                elif all('off' in s for s in ccg_states):
+                elif all(s=='OFF' for s in ccg_kinds):
                     channelstatus+='HV output is Off.\n'
                     state=DevState.OFF
                 #If there are other error messages
@@ -311,7 +477,7 @@ class MKSGaugeController(Dev4Tango):
                     channelstatus+='Some Controller Channel is NOT working properly, check device.\n'
                     self.info('Controller %s: %s'%(str(state),'; '.join(self.ChannelState.values())))
                     #<-State MUST be ALARM, to avoid CCG showing fake attribute readings!
-                    state=DevState.ALARM if any(fandango.matchAny(self.VALID_CODES,s) for s in ccg_states) else DevState.FAULT
+                    state=DevState.ALARM if any(s!='INVALID' for s in ccg_kinds) else DevState.FAULT
                 #channelstatus+='Channels:\n'
                 channelstatus+=','.join(['OK' in s and str(self.PressureValues[fun.str2int(k)-1]) or s for k,s in sorted(self.ChannelState.items()) if re.match('P[0-9]',k)])+'\n'
         self.channelstatus = channelstatus
@@ -330,11 +496,18 @@ class MKSGaugeController(Dev4Tango):
 #------------------------------------------------------------------
     def delete_device(self):
         self.warning( "[Device delete_device method] for device %s"%self.get_name())
-        if self.SVD: self.SVD.stop()
+        if self.SVD: 
+            from MKSSerialDevice import releaseSerialBus
+            releaseSerialBus(self.SVD,self.get_name())
+        if getattr(self,'sharedMemory',None) is not None:
+            memory,self.sharedMemory = self.sharedMemory,None
+            memory.close()
         #del self.SVD
         
     def __del__(self):
-        if self.SVD: self.SVD.stop()
+        if self.SVD: 
+            from MKSSerialDevice import releaseSerialBus
+            releaseSerialBus(self.SVD,self.get_name())
         try:type(self).__base__.__del__(self)
         except:pass
 
@@ -346,15 +519,20 @@ class MKSGaugeController(Dev4Tango):
         print "In ", self.get_name(), "::init_device()"
         self.exception,self.init_error,self.comms_report,self.channelstatus='','','',''
         self.last_state_change=0
+        self.sharedMemory=None
+        self.stateKey,self.stateExpires,self.noiseGeneration = None,0,0 #StateMachine is cached until the key changes
+        self.machineState,self.machineStatus = PyTango.DevState.UNKNOWN,''
+        self.startTime = time.time()
+        self.startup = [('import',IMPORT_TIME)]
         try:
             self.init_my_Logger()            
             self.get_device_properties(self.get_device_class())
+            self.startupMark('properties')
             if not hasattr(self,'LogLevel'): self.LogLevel = 'DEBUG'
             self.setLogLevel(self.LogLevel)            
             self.info(''.join(("In ", self.get_name(), "::init_device(%s)"%self.LogLevel)))
             self.set_state(PyTango.DevState.UNKNOWN)
                         
-            self.startTime = time.time()
             self.statesQueue = TimedQueue(self.get_state())
             
             if not hasattr(self,'Refresh') or not self.Refresh:
@@ -365,12 +543,33 @@ class MKSGaugeController(Dev4Tango):
                 self.Refresh = 5.
             self.info('Refresh period for full attribute reading cycle set to %s seconds.'%self.Refresh)
         
-            self.ChannelState={}#['Unknown']*5
-            self.PreviousValues=[0.0]*5
-            self.PressureValues=[0.0]*5
+            #Pressure and combination channels available in this controller model
+            if (self.Model or '937A').strip().upper() not in MKSProtocol.MODELS:
+                self.warning('Model %s not supported, using the 937A channels'%self.Model)
+            self.Channels,self.CombChannels=channelTable(self.Model,self.NChannels,self.NCombChannels)
+            self.addChannelAttributes(self.Channels+self.CombChannels)
+            self.ChannelState={}
+            self.PressureValues=[0.0]*len(self.Channels)
+            #Combination channels are computed locally from the P channels, unless read from hardware
+            self.LocalCombination = self.CombinationChannels.strip().lower()!='hardware'
+            self.LastReadings=dict((c,None) for c in self.Channels) #Last Reading pushed by events
+            self.snapshot=Snapshot(0,0,{}) #Replaced by the polling thread on every new channel reading
+            self.memo={} #{attribute:((generation,bus generation),value)}, see getMemo
+            self.readingFilter=MissreadingsFilter(self.MissreadingsTolerance,self.MissreadingsTimeout)
+            self.snapshotLock=RLock()
+            if self.SharedMemoryFile:
+                #Local processes can read the channels with MKSSharedMemory.readSharedMemory
+                from MKSSharedMemory import SharedMemoryWriter
+                self.sharedMemory = SharedMemoryWriter(self.SharedMemoryFile,self.Channels)
+            self.PollReadings,self.ChannelPeriods,self.piranis={},{},[]
+            self.History=dict((c,PressureHistory(self.HistoryLength)) for c in self.Channels)
+            self.Noise,self.EssentialComms={},[]
+            self.OscillationThresholds=list(self.OscillationThresholds)+[20,.3,2,2.,.1][len(self.OscillationThresholds):]
+            self.thresholds=parseThresholds(self.EventThresholds)
             
             try:
-                self.CommPrefix = ('422' in self.Protocol or '485' in self.Protocol) and '$0' or '' 
+                #Multidrop lines require the controller address
+                self.CommPrefix = ('422' in self.Protocol or '485' in self.Protocol) and '$%d'%(self.Address or 0) or '' 
             except: #Protocol property has not been set
                 self.CommPrefix = '' 
                 
@@ -382,13 +581,14 @@ class MKSGaugeController(Dev4Tango):
                 pass
             
             if self.LogLevel=='DEBUG':
+                from fandango.excepts import ExceptionWrapper
                 self.read_Pressure_channel=ExceptionWrapper(self.read_Pressure_channel,
                     logger=self,
                     verbose=True,
                     postmethod=(lambda exstring: self.__setattr__('last_exception',(time.time(),exstring)))
                     )
                 
-            if not self.SerialLine:
+            if not self.SerialLine and not self.Transport:
                 self.SVD = None
                 self.set_state(PyTango.DevState.FAULT)
                 self.error('SerialLine property requires a value!')
@@ -397,32 +597,53 @@ class MKSGaugeController(Dev4Tango):
             else:
                 #The arguments for SerialVacuumDevice are:
                 #    tangoDevice=SerialLineName, period=minimum time between communications, wait=time waiting for answer
-                from VacuumController import SerialVacuumDevice
-                self.SVD=SerialVacuumDevice(
-                    tangoDevice=self.SerialLine,
+                #All devices of this server using the same SerialLine share a single polling thread
+                #With Transport the port is opened directly, without the SerialLine device
+                from MKSSerialDevice import getSerialBus,getScheduler
+                #Lines of all the devices in the process are polled by a shared pool of PollingThreads
+                getScheduler(self.PollingThreads)
+                self.SVD=getSerialBus(
+                    self.Transport or self.SerialLine,
+                    self.get_name(),
                     period=self.Refresh, #Total refresh period divided by number of commands
                     wait=0.1, #Maximum time waiting for each command to succeed.
                     retries=3,
-                    log=self.LogLevel)
+                    log=self.LogLevel,
+                    transport=self.Transport or None)
+                self.startupMark('serial line')
                     
                 r = self.Refresh*20 # For slow commands
                 tt = fandango.now()
-                self.SVD.setPolledComm(self.CommPrefix+'GAUGES',r)
-                self.SVD.setPolledComm(self.CommPrefix+'P1',self.Refresh)
-                self.SVD.setPolledComm(self.CommPrefix+'P2',self.Refresh)
-                self.SVD.setPolledComm(self.CommPrefix+'P3',r)
-                self.SVD.setPolledComm(self.CommPrefix+'P4',self.Refresh)
-                self.SVD.setPolledComm(self.CommPrefix+'P5',self.Refresh)
-
-                self.SVD.setPolledComm(self.CommPrefix+'C1',r,tt+10)
-                self.SVD.setPolledComm(self.CommPrefix+'C2',r,tt+11)
-                [self.SVD.setPolledComm(self.CommPrefix+'PRO%d'%i,r,tt+12) 
-                    for i in (1,2)]
-                [self.SVD.setPolledComm(self.CommPrefix+'RLY%d'%i,r,tt+13)
-                    for i in range(1,6)]
-                self.SVD.setPolledComm(self.CommPrefix+'RELAYS',r,tt+14)               
-                self.SVD.setPolledComm(self.CommPrefix+'VER',r,tt+15)
+                poll = lambda comm,period,first=None: self.SVD.setPolledComm(self.CommPrefix+comm,period,first,owner=self.get_name())
+                poll('GAUGES',r)
+                channels = [(self.CommPrefix+c,r if c=='P3' else self.Refresh) for c in self.Channels]
+                if self.BulkCommand:
+                    #All channels read in a single transaction, channel commands kept as fallback
+                    self.info('Reading pressures with %s'%self.BulkCommand)
+                    self.SVD.setBulkComm(self.CommPrefix+self.BulkCommand,channels,self.Refresh,r,owner=self.get_name())
+                else:
+                    [self.SVD.setPolledComm(c,p,owner=self.get_name()) for c,p in channels]
+                self.ChannelPeriods=dict((c[len(self.CommPrefix):],p) for c,p in channels)
+                #Settings from the previous run are used until revalidated
+                self.WarmCache = self.loadCache() if self.CachePath else {}
+                #State is evaluated once modules and channels have been read
+                self.EssentialComms = ([] if 'GAUGES' in self.WarmCache else [self.CommPrefix+'GAUGES'])+(
+                    [self.CommPrefix+self.BulkCommand] if self.BulkCommand else [c for c,p in channels])
+
+                #Slow commands are first read one per Refresh cycle, instead of waiting 10-15 seconds;
+                #if cached, they are revalidated along the slow period to not compete with pressure reads
+                slow = ['VER','PRO1','PRO2','RELAYS']+['RLY%d'%i for i in range(1,6)]
+                if not self.LocalCombination: slow.extend(self.CombChannels)
+                step = r/len(slow) if self.WarmCache else self.Refresh
+                [poll(c,r,tt+(i+1)*step) for i,c in enumerate(slow)]
+
+                #Events are pushed by the device, without Tango checking the thresholds
+                for a in sorted(self.LastReadings)+['PressureValues','ChannelState']:
+                    self.set_change_event(a,True,False)
+                    self.set_archive_event(a,True,False)
+                self.SVD.addListener(self.get_name(),self.processReply)
                 self.SVD.start()
+                self.startupMark('polling started')
             
         except Exception,e:
             self.error('Exception in MKSGaugeController.init_device(): '+traceback.format_exc())
@@ -433,23 +654,41 @@ class MKSGaugeController(Dev4Tango):
         self.info("Ready to accept request.")
         self.info('-'*80)
 
+    def startupMark(self,phase):
+        """ Records the seconds elapsed since init_device started, only the first time for each phase """
+        if not any(p==phase for p,t in self.startup):
+            self.startup.append((phase,time.time()-self.startTime))
+            self.info('Startup: %s after %1.3f seconds'%self.startup[-1])
+
 #------------------------------------------------------------------
 #    Always excuted hook method
 #------------------------------------------------------------------
     def always_executed_hook(self):
         self.debug("In "+self.get_name()+"::always_executed_hook()")
         try:
-            prev = self.get_state()
-            try: self.read_ChannelState() #Updating ChannelState from cached serial values
-            except: pass
-            state = self.StateMachine(prev)
-            
-            if self.SerialLine and self.SVD:
-                self.comms_report=self.SVD.getReport()
-                status = '\n'.join(s for s in [self.channelstatus,self.Description,self.init_error,self.comms_report,'',self.exception.replace('\n',''),] if s)
-            else: 
-                self.debug('SerialLine property requires a value!')
-                status = 'SerialLine property requires a value!'            
+            prev,now = self.get_state(),time.time()
+            #Held readings expire even if the polling thread gets no more replies
+            if self.SVD: self.expireReadings(now)
+            #State and status are evaluated again only if the polling thread updated any value;
+            #the snapshot generation covers readings published after the bus generation changed
+            key = (self.snapshot.generation,self.SVD.getGeneration(self.get_name()) if self.SVD else None,
+                self.noiseGeneration,self.exception)
+            if key!=self.stateKey or now>self.stateExpires:
+                self.stateKey = key
+                self.machineState = state = self.StateMachine(prev)
+                if self.SVD:
+                    self.comms_report=self.SVD.getReport(self.get_name())
+                    self.machineStatus = '\n'.join(s for s in [self.channelstatus,self.Description,self.init_error,self.comms_report,'',self.exception.replace('\n',''),] if s)
+                    #Communication is considered lost after 2 minutes without replies
+                    lasttime = self.SVD.getLastTime(self.get_name())
+                    self.stateExpires = lasttime+2*60 if lasttime+2*60>now else now+self.Refresh
+                    if self.SVD.isOpen(self.get_name()): #Nothing changes until the next retry
+                        self.stateExpires = max(now+self.Refresh,self.SVD.getProbeTime(self.get_name()))
+                else: 
+                    self.debug('SerialLine property requires a value!')
+                    self.machineStatus = 'SerialLine property requires a value!'
+                    self.stateExpires = now+self.Refresh
+            state,status = self.machineState,self.machineStatus
             
             if prev!=state: #New states are added to StatesQueue
                 keep_time = 20 #Any Wrong State should be kept at least for 20 seconds!
@@ -470,6 +709,8 @@ class MKSGaugeController(Dev4Tango):
                 self.info( '*'*80)
                 self.last_state_change=time.time()
                 self.set_state(state)
+                if state not in (DevState.INIT,DevState.UNKNOWN): 
+                    self.startupMark('first valid state')
                 #self.last_state = state                
                 if prev==DevState.INIT and state!=DevState.UNKNOWN:
                     if self.StartSequence: 
@@ -494,97 +735,29 @@ class MKSGaugeController(Dev4Tango):
 
 
 #------------------------------------------------------------------
-#    Read P1 attribute
+#    Read channel attributes (P1..Pn, C1..Cm), created from the channel table
 #------------------------------------------------------------------
-    @self_locked
-    def read_P1(self, attr):
-        self.debug("In "+self.get_name()+"::read_P1()")
+    def read_Channel(self, attr):
+        name = attr.get_name()
+        self.debug("In "+self.get_name()+"::read_Channel(%s)"%name)
         
         #    Add your own code here
-        self.read_Pressure_channel(attr,'P',1)
-
-
-#------------------------------------------------------------------
-#    Read P2 attribute
-#------------------------------------------------------------------
-    @self_locked
-    def read_P2(self, attr):
-        self.debug("In "+self.get_name()+"::read_P2()")
-        
-        #    Add your own code here
-        self.read_Pressure_channel(attr,'P',2)
-
-
-#------------------------------------------------------------------
-#    Read P3 attribute
-#------------------------------------------------------------------
-    @self_locked
-    def read_P3(self, attr):
-        self.debug("In "+self.get_name()+"::read_P3()")
-        
-        #    Add your own code here
-        self.read_Pressure_channel(attr,'P',3)
-
-
-#------------------------------------------------------------------
-#    Read P4 attribute
-#------------------------------------------------------------------
-    @self_locked
-    def read_P4(self, attr):
-        self.debug("In "+self.get_name()+"::read_P4()")
-        
-        #    Add your own code here
-        self.read_Pressure_channel(attr,'P',4)
-
-
-#------------------------------------------------------------------
-#    Read P5 attribute
-#------------------------------------------------------------------
-    @self_locked
-    def read_P5(self, attr):
-        self.debug("In "+self.get_name()+"::read_P5()")
-        
-        #    Add your own code here
-        self.read_Pressure_channel(attr,'P',5)
-
-##------------------------------------------------------------------
-##    Read C1 attribute
-##------------------------------------------------------------------
-    #def read_C1(self, attr):
-        #self.debug("In "+self.get_name()+"::read_C1()")
-        
-        ##    Add your own code here
-        #self.read_Pressure_channel(attr,'C',1)
-
-##------------------------------------------------------------------
-##    Read C2 attribute
-##------------------------------------------------------------------
-    #def read_C2(self, attr):
-        #self.debug("In "+self.get_name()+"::read_C2()")
-        
-        ##    Add your own code here
-        #self.read_Pressure_channel(attr,'C',2)
+        self.read_Pressure_channel(attr,name[0],int(name[1:]))
 
 #------------------------------------------------------------------
 #    Read ChannelState attribute
 #------------------------------------------------------------------
-    @self_locked
     def read_ChannelState(self, attr=None):
         self.debug("In "+self.get_name()+"::read_ChannelState()")
         
         #    Add your own code here
-        for i in range(5):
-            s = self.SVD.getComm(self.CommPrefix+'P'+str(i+1))
-            try:
-                float(s)
-                s=s#'OK'
-            except: pass
-            self.ChannelState['P'+str(i+1)] = s or 'Unknown'
-        attr_ChannelState_read=[]
-        for k,v in sorted(self.ChannelState.items()):
-            attr_ChannelState_read.append('%s:%s'%(k,v))
+        def channelState():
+            samples = self.snapshot.samples
+            return ['%s:%s'%(k,k in samples and samples[k].reading.raw or 'Unknown') for k in self.Channels]
+        attr_ChannelState_read = self.getMemo('ChannelState',channelState)
         if attr is not None:
             attr.set_value(attr_ChannelState_read)
+        return attr_ChannelState_read
 
 
 ##------------------------------------------------------------------
@@ -644,10 +817,29 @@ class MKSGaugeController(Dev4Tango):
         self.debug("In "+self.get_name()+"::read_SerialLine()")
         
         #    Add your own code here
-        attr_SerialLine_read = self.SerialLine[:]
+        attr_SerialLine_read = (self.Transport or self.SerialLine)[:]
         attr.set_value(attr_SerialLine_read)                    
 
 
+#------------------------------------------------------------------
+#    Read StartupReport attribute
+#------------------------------------------------------------------
+    def read_StartupReport(self, attr):
+        self.debug("In "+self.get_name()+"::read_StartupReport()")
+        
+        #    Add your own code here
+        attr.set_value('\n'.join('%s: %1.3f s'%(p,t) for p,t in self.startup))
+
+#------------------------------------------------------------------
+#    Read CommStats attribute
+#------------------------------------------------------------------
+    def read_CommStats(self, attr):
+        self.debug("In "+self.get_name()+"::read_CommStats()")
+        
+        #    Add your own code here
+        stats = self.SVD.getCommStats(self.get_name()) if self.SVD else {}
+        attr.set_value(json.dumps(dict((c[len(self.CommPrefix):],v) for c,v in stats.items()),sort_keys=True))
+
 #------------------------------------------------------------------
 #    Read ModulesInstalled attribute
 #------------------------------------------------------------------
@@ -656,23 +848,7 @@ class MKSGaugeController(Dev4Tango):
         
         #    Add your own code here
         try:                    
-            modules = self.read_modules()
-            CC,A,B=modules[0:2],modules[2:4],modules[4:]
-            codes={
-                'Hc':'HotCathode',
-                'Cc':'ColdCathode',
-                'Pr':'Pirani',
-                'Cv':'ConvectionPirani',
-                'Tc':'DualThermocouple',
-                'Cm':'DualManometer',
-                'P1':'SinglePirani',
-                'C1':'SingleConvectionPirani',
-                'T1':'SingleThermocouple',
-                'M1':'SingleManometer',
-                'Nc':'NoModule',
-                'Wc':'WrongModuleConnected',
-                }
-            attr_ModulesInstalled_read = 'P1=CC:%s; P2=A:%s; P4=B:%s'%(codes[CC],codes[A],codes[B])
+            attr_ModulesInstalled_read = describeModules(self.read_modules())
             if attr:
                 attr.set_value(attr_ModulesInstalled_read)
             else:
@@ -688,17 +864,9 @@ class MKSGaugeController(Dev4Tango):
         self.debug("In "+self.get_name()+"::read_PressureValues()")
         
         #    Add your own code here
-        for i,k in enumerate(sorted(self.ChannelState.keys())):
-            try:
-                s = self.SVD.getComm(self.CommPrefix+k)
-                v = float(s)
-            except:
-                v = 0.0
-            self.PreviousValues[i] = self.PressureValues[i]
-            self.PressureValues[i] = v
-        
+        #Updated by the polling thread on every new generation, see publishSnapshot
         attr_PressureValues_read = self.PressureValues #[1.0]
-        attr.set_value(attr_PressureValues_read, 5)
+        attr.set_value(attr_PressureValues_read, len(attr_PressureValues_read))
         
 #------------------------------------------------------------------
 #    Read ProtectSetPoints attribute
@@ -707,7 +875,7 @@ class MKSGaugeController(Dev4Tango):
         self.debug( "In "+ self.get_name()+ "::read_ProtectSetpoints()")
         
         #    Add your own code here
-        attr_read = [s for s in (self.SVD.getComm(self.CommPrefix+'PRO%d'%i) for i in (1,2))]
+        attr_read = self.getMemo('ProtectSetpoints',lambda: [self.SVD.getComm(self.CommPrefix+'PRO%d'%i) for i in (1,2)])
         attr.set_value(attr_read, len(attr_read))
         
 #------------------------------------------------------------------
@@ -735,7 +903,7 @@ class MKSGaugeController(Dev4Tango):
         self.debug( "In "+ self.get_name()+ "::read_RelaySetpoints()")
         
         #    Add your own code here
-        attr_read = [s for s in (self.SVD.getComm(self.CommPrefix+'RLY%d'%i) for i in (1,2,3,4,5))]
+        attr_read = self.getMemo('RelaySetpoints',lambda: [self.SVD.getComm(self.CommPrefix+'RLY%d'%i) for i in (1,2,3,4,5)])
         attr.set_value(attr_read, len(attr_read))
         
 #------------------------------------------------------------------
@@ -762,9 +930,21 @@ class MKSGaugeController(Dev4Tango):
         self.debug( "In "+ self.get_name()+ "::read_Relays()")
         
         #    Add your own code here
-        attr_read = [bool(int(s)) for s in self.SVD.getComm(self.CommPrefix+'RELAYS').strip()[-5:]]
+        attr_read = self.getMemo('Relays',lambda: [bool(int(s)) for s in self.SVD.getComm(self.CommPrefix+'RELAYS').strip()[-5:]])
         attr.set_value(attr_read, len(attr_read))
 
+#------------------------------------------------------------------
+#    Read PressureStats attribute
+#------------------------------------------------------------------
+    def read_PressureStats(self, attr):
+        self.debug( "In "+ self.get_name()+ "::read_PressureStats()")
+        
+        #    Add your own code here
+        #One row per channel: min,max,mean,std for each of StatsWindows
+        rows = [sum((list(self.History[k].stats(w)[:4]) for w in self.StatsWindows),[]) 
+            for k in sorted(self.History)]
+        attr.set_value(sum(rows,[]),4*len(self.StatsWindows),len(rows))
+
 #==================================================================
 #
 #    MKSGaugeController command methods
@@ -784,15 +964,23 @@ class MKSGaugeController(Dev4Tango):
         #    Add your own code here
         self.info('>'*80)
         result = ''
-        self.SVD.stop()
-        if self.SVD.Alive:
-            self.warning( 'SVD IS STILL ALIVE!!!')
         try:
             argin = fun.toSequence(argin)
-            for arg in argin:
-                result+=self.SVD.serialComm(arg)+separator
-                self.info('===> %s'%(arg))
-                self.SVD.event.wait(.1)
+            #Commands are queued and sent by the polling thread between polled commands
+            replies = [self.SVD.submit(arg,wait=False) for arg in argin]
+            #A single deadline for all of them, so the client does not time out while they are still queued
+            deadline = time.time()+self.SVD.QUEUE_TIMEOUT
+            try:
+                for arg,reply in zip(argin,replies):
+                    answer = reply.get(max(0.,deadline-time.time()))
+                    if answer is None:
+                        raise Exception('MKS_NoReply: %s not replied'%arg)
+                    result+=str(answer)+separator
+                    self.info('===> %s'%(arg))
+            except:
+                #Commands not sent yet must not reach the hardware after the caller got an error
+                [reply.cancel() for reply in replies]
+                raise
             result = result.strip()
             self.info('<=== %s'%result)
         except PyTango.DevFailed, e:
@@ -802,10 +990,81 @@ class MKSGaugeController(Dev4Tango):
             self.error('Exception in sendCommand():%s'%traceback.format_exc())
             #self.setStatus(self.getStatus())
             raise Exception('Exception in sendCommand():', traceback.format_exc())
-        self.SVD.start()
         self.info('<'*80)
         return result
     
+#------------------------------------------------------------------
+#    GetHistory command:
+#
+#    Description: Returns the last samples stored for a channel
+#                
+#    argin:  DevVarStringArray    Channel name, number of samples (optional)
+#    argout: DevVarDoubleArray    timestamp,value,quality for each sample, oldest first
+#------------------------------------------------------------------
+    def GetHistory(self, argin):
+        self.debug("In "+self.get_name()+"::GetHistory()")
+        #    Add your own code here
+        channel = argin[0].upper().strip()
+        if channel not in self.History:
+            raise Exception('GetHistory_UnknownChannel%s'%channel)
+        n = int(argin[1]) if len(argin)>1 else None
+        times,values,qualities = self.History[channel].last(n)
+        return [x for sample in zip(times,values,qualities) for x in sample]
+
+#------------------------------------------------------------------
+#    GetSnapshot command:
+#
+#    Description: Returns all the controller values from a single poll generation
+#                
+#    argout: DevString    JSON dict: generation, timestamp, state, attribute values
+#                         and fields {command:{value,raw,quality,timestamp}}
+#------------------------------------------------------------------
+    def GetSnapshot(self):
+        self.debug("In "+self.get_name()+"::GetSnapshot()")
+        #    Add your own code here
+        snapshot = self.snapshot
+        samples,fields = snapshot.samples,{}
+        for k,sample in samples.items():
+            r = sample.reading
+            if k in self.Channels:
+                value,quality = r.value,r.quality
+            else:
+                value,quality = r.raw,'VALID' if isValidReply(k,r.raw) else 'INVALID'
+            fields[k] = {'value':value,'raw':r.raw,'quality':quality,'timestamp':sample.timestamp}
+        raw = lambda k: k in samples and samples[k].reading.raw or None
+        channels = sorted(k for k in samples if k in self.Channels)
+        relays = raw('RELAYS')
+        return json.dumps({
+            'generation':snapshot.generation,
+            'timestamp':snapshot.timestamp,
+            'state':str(self.get_state()),
+            'PressureValues':[samples[k].reading.value if samples[k].reading.kind=='FLOAT' else 0. for k in channels],
+            'ChannelState':['%s:%s'%(k,samples[k].reading.raw or 'Unknown') for k in channels],
+            'ModulesInstalled':describeModules(raw('GAUGES')) if isValidReply('GAUGES',raw('GAUGES')) else None,
+            'FirmwareVersion':raw('VER'),
+            'ProtectSetpoints':[raw('PRO%d'%i) for i in (1,2)],
+            'RelaySetpoints':[raw('RLY%d'%i) for i in range(1,6)],
+            'Relays':[bool(int(c)) for c in relays.strip()[-5:]] if isValidReply('RELAYS',relays) else None,
+            'fields':fields,
+            },sort_keys=True)
+
+#------------------------------------------------------------------
+#    GetStatistics command:
+#
+#    Description: Returns the statistics of a channel in a time window
+#                
+#    argin:  DevVarStringArray    Channel name, window in seconds
+#    argout: DevVarDoubleArray    min,max,mean,std,count
+#------------------------------------------------------------------
+    def GetStatistics(self, argin):
+        self.debug("In "+self.get_name()+"::GetStatistics()")
+        #    Add your own code here
+        channel = argin[0].upper().strip()
+        if channel not in self.History:
+            raise Exception('GetStatistics_UnknownChannel%s'%channel)
+        window = float(argin[1]) if len(argin)>1 else self.StatsWindows[0]
+        return list(self.History[channel].stats(window))
+
 #------------------------------------------------------------------
 #    getChannelState command:
 #
@@ -887,6 +1146,7 @@ class MKSGaugeController(Dev4Tango):
             if 'PENDING' in result:
                 ev.wait(0.51)
                 result=self.SendCommand(command)
+            self.resetPollingPeriod('P%d'%chans[argin])
             return result
         else:
             raise Exception('CC_On_UnknownChannel%s'%str(argin))
@@ -915,6 +1175,7 @@ class MKSGaugeController(Dev4Tango):
         elif argin in chans.keys():
             command=self.CommPrefix+'XCC'+str(chans[argin])
             result=self.SendCommand(command)
+            self.resetPollingPeriod('P%d'%chans[argin])
             return result
         else:
             raise Exception('CC_Off_UnknownChannel%s'%str(argin))
@@ -933,6 +1194,10 @@ class MKSGaugeControllerClass(PyTango.PyDeviceClass):
             [PyTango.DevDouble,
             "Period (in seconds) for the internal refresh thread.",
             [ 3. ] ],
+        'PollingThreads':
+            [PyTango.DevLong,
+            "Number of threads polling the serial lines of all the devices in the process; a line waiting for a reply keeps its thread busy",
+            [ 4 ] ],
         }
 
 
@@ -942,18 +1207,30 @@ class MKSGaugeControllerClass(PyTango.PyDeviceClass):
             [PyTango.DevString,
             "SerialLine Device Server to connect with",
             [''] ],
+        'Transport':
+            [PyTango.DevString,
+            "Direct connection used instead of SerialLine: tcp://host:port (terminal server) or /dev/ttyXX[:baudrate]; empty to use SerialLine",
+            [''] ],
         'Protocol':
             [PyTango.DevString,
             "SerialLine Physical Protocol used (232/422/485)",
             ['232'] ],            
+        'Address':
+            [PyTango.DevLong,
+            "Controller address for 422/485 multidrop lines; devices in the same server share the SerialLine",
+            [ 0 ] ],
+        'Model':
+            [PyTango.DevString,
+            "Controller model (only 937A is supported), it sets the number of channels if NChannels/NCombChannels are -1",
+            [ '937A' ] ],
         'NChannels':
             [PyTango.DevLong,
-            "Number of Pressure Channels available",
-            [ 5 ] ],
+            "Number of Pressure Channels available (e.g. 2 for single module units); -1 to use the Model ones",
+            [ -1 ] ],
         'NCombChannels':
             [PyTango.DevLong,
-            "Number of Combination Channels available",
-            [ 2 ] ],
+            "Number of Combination Channels available; -1 to use the Model ones",
+            [ -1 ] ],
         'Description':
             [PyTango.DevString,
             "This string field will appear in the status and can be used to add extra information about equipment location",
@@ -962,6 +1239,50 @@ class MKSGaugeControllerClass(PyTango.PyDeviceClass):
             [PyTango.DevDouble,
             "Period (in seconds) for the internal refresh thread (1 entire cycle).",
             [ 0.1 ] ],
+        'BulkCommand':
+            [PyTango.DevString,
+            "Command returning all channel pressures in a single reply (firmware dependent), empty to read each channel separately",
+            [''] ],
+        'EventThresholds':
+            [PyTango.DevVarStringArray,
+            "Change/archive events thresholds as channel:absolute,relative lines (e.g. P1:1e-10,0.05); * sets the default, 0,0 pushes any change",
+            ['*:0,0.01'] ],
+        'AdaptivePolling':
+            [PyTango.DevDouble,
+            "Channels off, without gauge or stable below range are polled this times slower; changing channels twice faster. 0 to disable",
+            [ 5. ] ],
+        'HistoryLength':
+            [PyTango.DevLong,
+            "Number of samples kept in memory for each channel",
+            [ 3600 ] ],
+        'StatsWindows':
+            [PyTango.DevVarDoubleArray,
+            "Time windows (in seconds) used for the PressureStats attribute",
+            [ 60., 600. ] ],
+        'OscillationThresholds':
+            [PyTango.DevVarDoubleArray,
+            "samples analyzed, spike size (decades), spikes to consider a gauge oscillating, drift (decades/minute) to consider it moving, variance (decades^2) to consider it noisy (0 to disable)",
+            [ 20, 0.3, 2, 2., 0.1 ] ],
+        'MissreadingsTolerance':
+            [PyTango.DevLong,
+            "Consecutive failed readings of a channel needed to replace its last good value; 1 to disable the filter",
+            [3] ],
+        'MissreadingsTimeout':
+            [PyTango.DevDouble,
+            "Seconds since the first of consecutive failed readings after which a channel shows the failure, regardless of MissreadingsTolerance; 0 to disable",
+            [10.] ],
+        'CombinationChannels':
+            [PyTango.DevString,
+            "C1/C2 source: local (computed from the cold cathode and Pirani channels, crossover at its PRO setpoint) or hardware (C1/C2 commands)",
+            ['local'] ],
+        'SharedMemoryFile':
+            [PyTango.DevString,
+            "Memory mapped file (e.g. /dev/shm/<device>) where the last channel readings are exported for local processes, see MKSSharedMemory.py; empty to disable",
+            [''] ],
+        'CachePath':
+            [PyTango.DevString,
+            "Folder where modules, firmware and setpoints are saved to be used on next startup (e.g. /var/tmp/MKSGaugeController); empty (default) to disable",
+            [''] ],
         'DefaultStatus':
             [PyTango.DevString,
             "On/Off,On/Off; the expected status for each channel, empty if not used",
@@ -995,8 +1316,8 @@ class MKSGaugeControllerClass(PyTango.PyDeviceClass):
                 'Display level':PyTango.DispLevel.EXPERT,
              } ],
         'Off':
-            [[PyTango.DevVoid, "Switchs On HighVoltage for CCs configured as on in DefaultStatus property"],
-            [PyTango.DevString, "Switchs On HighVoltage for CCs configured as on in DefaultStatus property"],
+            [[PyTango.DevVoid, "Switchs Off HighVoltage for all the CCs"],
+            [PyTango.DevString, "Switchs Off HighVoltage for all the CCs"],
             {
                 'Display level':PyTango.DispLevel.EXPERT,
              } ],             
@@ -1012,6 +1333,15 @@ class MKSGaugeControllerClass(PyTango.PyDeviceClass):
             {
                 'Display level':PyTango.DispLevel.EXPERT,
              } ],
+        'GetHistory':
+            [[PyTango.DevVarStringArray, "Channel name, number of samples (optional)"],
+            [PyTango.DevVarDoubleArray, "timestamp,value,quality for each sample, oldest first"]],
+        'GetSnapshot':
+            [[PyTango.DevVoid, ""],
+            [PyTango.DevString, "JSON dict with all the controller values, timestamps and qualities from a single poll generation"]],
+        'GetStatistics':
+            [[PyTango.DevVarStringArray, "Channel name, window in seconds"],
+            [PyTango.DevVarDoubleArray, "min,max,mean,std,count of the valid values in the window"]],
         'WarmUp':
             [[PyTango.DevVoid, "Executes StartSequence"],
             [PyTango.DevString, "Executes StartSequence"],
@@ -1021,62 +1351,6 @@ class MKSGaugeControllerClass(PyTango.PyDeviceClass):
 
     #    Attribute definitions
     attr_list = {
-        'P1':
-            [[PyTango.DevDouble,
-            PyTango.SCALAR,
-            PyTango.READ],
-            {
-                'unit':"mbar",
-                'format':"%5.2e",
-            } ],
-        'P2':
-            [[PyTango.DevDouble,
-            PyTango.SCALAR,
-            PyTango.READ],
-            {
-                'unit':"mbar",
-                'format':"%5.2e",
-            } ],
-        'P3':
-            [[PyTango.DevDouble,
-            PyTango.SCALAR,
-            PyTango.READ],
-            {
-                'unit':"mbar",
-                'format':"%5.2e",
-            } ],
-        'P4':
-            [[PyTango.DevDouble,
-            PyTango.SCALAR,
-            PyTango.READ],
-            {
-                'unit':"mbar",
-                'format':"%5.2e",
-            } ],
-        'P5':
-            [[PyTango.DevDouble,
-            PyTango.SCALAR,
-            PyTango.READ],
-            {
-                'unit':"mbar",
-                'format':"%5.2e",
-            } ],
-        #"""'C1':
-            #[[PyTango.DevDouble,
-            #PyTango.SCALAR,
-            #PyTango.READ],
-            #{
-                #'unit':"mbar",
-                #'format':"%5.2e",
-            #} ],
-        #'C2':
-            #[[PyTango.DevDouble,
-            #PyTango.SCALAR,
-            #PyTango.READ],
-            #{
-                #'unit':"mbar",
-                #'format':"%5.2e",
-            #} ],"""
         'ChannelState':
             [[PyTango.DevString,
             PyTango.SPECTRUM,
@@ -1109,6 +1383,19 @@ class MKSGaugeControllerClass(PyTango.PyDeviceClass):
             [[PyTango.DevString,
             PyTango.SCALAR,
             PyTango.READ]],            
+        'StartupReport':
+            [[PyTango.DevString,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {'Display level':PyTango.DispLevel.EXPERT,} ],
+        'CommStats':
+            [[PyTango.DevString,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description':"JSON dict with count, timeouts, retries, invalid replies, p50/p95/p99 latency and configured/achieved period of each command",
+                'Display level':PyTango.DispLevel.EXPERT,
+            } ],
         'ModulesInstalled':
             [[PyTango.DevString,
             PyTango.SCALAR,
@@ -1133,11 +1420,23 @@ class MKSGaugeControllerClass(PyTango.PyDeviceClass):
             [[PyTango.DevBoolean,
             PyTango.SPECTRUM,
             PyTango.READ, 5]],
+        'PressureStats':
+            [[PyTango.DevDouble,
+            PyTango.IMAGE,
+            PyTango.READ, 32, 16],
+            {
+                'description':"One row per channel; min,max,mean,std for each of StatsWindows",
+            } ],
         'Missreadings':
             [[PyTango.DevString,
             PyTango.SPECTRUM,PyTango.READ, 256],
             {'Display Level':PyTango.DispLevel.EXPERT,}, 
             ],
+        'MissreadingsSummary':
+            [[PyTango.DevString,
+            PyTango.SCALAR,PyTango.READ],
+            {'Display Level':PyTango.DispLevel.EXPERT,}, 
+            ],
         }
 
 
@@ -1161,15 +1460,26 @@ def addLoggingToTangoClass(Klass):
 #MKSGaugeControllerClass.device_property_list['LogLevel']=[PyTango.DevString,"LogLevel: ERROR/WARNING/INFO/DEBUG",['INFO'] ]
 MKSGaugeControllerClass=addLoggingToTangoClass(MKSGaugeControllerClass)
     
-def manageMissreadings(obj,attr=None,value=None):
-    if not hasattr(obj,'missreadings'): setattr(obj,'missreadings',[])
-    if value is not None and value not in obj.missreadings: obj.missreadings.append(str(value))
-    if len(obj.missreadings)>256: obj.missreadings=obj.missreadings[-256:-1]+[obj.missreadings[-1]]
-    if attr is not None: attr.set_value(obj.missreadings)
-    return obj.missreadings
+def manageMissreadings(obj,attr=None,value=None,channel=''):
+    if not hasattr(obj,'missreadings'): setattr(obj,'missreadings',MissreadingsLog(256))
+    if value is not None: obj.missreadings.add(value,channel)
+    lines = ['%s %r x%d, first %s, last %s'%(c,raw,n,time.ctime(first),time.ctime(last))
+        for raw,c,first,last,n in obj.missreadings.items()]
+    if attr is not None: attr.set_value(lines)
+    return lines
+
+def read_MissreadingsSummary(obj,attr=None):
+    if not hasattr(obj,'missreadings'): setattr(obj,'missreadings',MissreadingsLog(256))
+    total,distinct,channels,last = obj.missreadings.summary()
+    summary = '%d missreadings (%d distinct) since %s'%(total,distinct,time.ctime(obj.missreadings.since))
+    if total:
+        summary += ', last at %s; %s'%(time.ctime(last),', '.join('%s:%d'%(c or '?',n) for c,n in sorted(channels.items())))
+    if attr is not None: attr.set_value(summary)
+    return summary
     
 MKSGaugeController.manageMissreadings = manageMissreadings
 MKSGaugeController.read_Missreadings = manageMissreadings
+MKSGaugeController.read_MissreadingsSummary = read_MissreadingsSummary
 
 #==================================================================
 #
@@ -0,0 +1,235 @@
+#=============================================================================
+#
+# file :        MKSHistory.py
+#
+# description : In-memory history of pressure readings, kept in fixed size
+#                ring buffers of array.array; numpy is used if available.
+#
+# project :    VacuumController Device Server
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import time,math,threading
+from array import array
+from collections import namedtuple,OrderedDict
+
+
+from MKSProtocol import QUALITIES,FAILURE_KINDS,Sample
+
+NaN = float('nan')
+
+_numpy = []
+
+def getNumpy():
+    """ numpy is optional and imported on first use, returns None if not available """
+    if not _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy.append(numpy)
+    return _numpy[0]
+
+#slope in decades per second, variance of log10(pressure), number of reverted jumps
+Noise = namedtuple('Noise','slope variance spikes')
+
+def detectNoise(times,values,spike=.3):
+    """
+    Analyzes a series of pressure samples in log10 scale, non positive or NaN values are ignored.
+    A spike is a jump bigger than spike decades immediately reverted by the next sample.
+    """
+    numpy = getNumpy()
+    if numpy is not None:
+        t,v = numpy.asarray(times,dtype=float),numpy.asarray(values,dtype=float)
+        ok = v>0
+        t,lv = t[ok],numpy.log10(v[ok])
+        if len(lv)<3:
+            return Noise(0.,0.,0)
+        d = numpy.diff(lv)
+        spikes = int(numpy.sum((numpy.abs(d[:-1])>spike)&(numpy.abs(d[1:])>spike)&(d[:-1]*d[1:]<0)))
+        t = t-t.mean()
+        tt = float((t*t).sum())
+        slope = float((t*(lv-lv.mean())).sum()/tt) if tt else 0.
+        return Noise(slope,float(lv.var()),spikes)
+    samples = [(t,math.log10(v)) for t,v in zip(times,values) if v>0]
+    if len(samples)<3:
+        return Noise(0.,0.,0)
+    n = len(samples)
+    tm,lm = sum(t for t,l in samples)/n,sum(l for t,l in samples)/n
+    d = [b[1]-a[1] for a,b in zip(samples,samples[1:])]
+    spikes = sum(1 for a,b in zip(d,d[1:]) if abs(a)>spike and abs(b)>spike and a*b<0)
+    tt = sum((t-tm)**2 for t,l in samples)
+    slope = sum((t-tm)*(l-lm) for t,l in samples)/tt if tt else 0.
+    return Noise(slope,sum((l-lm)**2 for t,l in samples)/n,spikes)
+
+class PressureHistory(object):
+    """
+    Ring buffer of (timestamp,value,quality) samples of a channel.
+    Quality is stored as the index in MKSProtocol.QUALITIES, None values as NaN.
+    """
+
+    def __init__(self,size=3600):
+        self.size = max(1,int(size))
+        self.times = array('d',[0.]*self.size)
+        self.values = array('d',[NaN]*self.size)
+        self.qualities = array('b',[QUALITIES.index('INVALID')]*self.size)
+        self.index,self.count = 0,0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self,timestamp,value,quality='VALID'):
+        with self.lock:
+            i = self.index
+            self.times[i] = timestamp
+            self.values[i] = NaN if value is None else value
+            self.qualities[i] = QUALITIES.index(quality)
+            self.index = (i+1)%self.size
+            self.count = min(self.count+1,self.size)
+
+    def last(self,n=None):
+        """ Returns the last n samples, oldest first, as (times,values,qualities) lists """
+        with self.lock:
+            n = self.count if n is None else max(0,min(n,self.count))
+            start = (self.index-n)%self.size
+            if start+n<=self.size:
+                s = slice(start,start+n)
+                return list(self.times[s]),list(self.values[s]),list(self.qualities[s])
+            s1,s2 = slice(start,self.size),slice(0,start+n-self.size)
+            return (list(self.times[s1])+list(self.times[s2]),list(self.values[s1])+list(self.values[s2]),
+                list(self.qualities[s1])+list(self.qualities[s2]))
+
+    def noise(self,n=20,spike=.3):
+        """ Returns the Noise of the last n samples """
+        times,values,qualities = self.last(n)
+        return detectNoise(times,values,spike)
+
+    def window(self,seconds,now=None):
+        """ Returns (times,values) of the valid samples of the last seconds """
+        now = now or time.time()
+        times,values,qualities = self.last()
+        valid = [(t,v) for t,v in zip(times,values) if t>=now-seconds and v==v]
+        return [t for t,v in valid],[v for t,v in valid]
+
+    def stats(self,seconds,now=None):
+        """ Returns (min,max,mean,std,count) of the valid values of the last seconds """
+        now = now or time.time()
+        numpy = getNumpy()
+        if numpy is not None:
+            with self.lock:
+                t,v = numpy.array(self.times),numpy.array(self.values)
+            v = v[(t>=now-seconds)&~numpy.isnan(v)]
+            if not len(v):
+                return (NaN,NaN,NaN,NaN,0)
+            return (float(v.min()),float(v.max()),float(v.mean()),float(v.std()),len(v))
+        times,values = self.window(seconds,now)
+        if not values:
+            return (NaN,NaN,NaN,NaN,0)
+        mean = sum(values)/len(values)
+        std = math.sqrt(sum((x-mean)**2 for x in values)/len(values))
+        return (min(values),max(values),mean,std,len(values))
+
+class MissreadingsLog(object):
+    """
+    Bounded log of distinct bad replies, indexed by raw reply.
+    Each entry keeps [channel,first time,last time,count]; when size is
+    exceeded the entry not seen for the longest time is dropped.
+    """
+
+    def __init__(self,size=256):
+        self.size = max(1,int(size))
+        self.entries = OrderedDict() #{raw:[channel,first,last,count]}, oldest first
+        self.total,self.since = 0,time.time()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self,raw,channel='',timestamp=None):
+        timestamp = timestamp or time.time()
+        raw = str(raw)
+        with self.lock:
+            self.total+=1
+            entry = self.entries.pop(raw,None)
+            if entry is None:
+                entry = [channel,timestamp,timestamp,0]
+                if len(self.entries)>=self.size:
+                    self.entries.popitem(last=False)
+            entry[0],entry[2],entry[3] = channel or entry[0],timestamp,entry[3]+1
+            self.entries[raw] = entry
+
+    def items(self):
+        """ Returns (raw,channel,first,last,count) tuples, oldest first """
+        with self.lock:
+            return [(raw,)+tuple(e) for raw,e in self.entries.items()]
+
+    def summary(self):
+        """ Returns (total,distinct,{channel:count},last time) """
+        channels,last = {},0
+        for raw,channel,first,t,count in self.items():
+            channels[channel] = channels.get(channel,0)+count
+            last = max(last,t)
+        return self.total,len(self.entries),channels,last
+
+class MissreadingsFilter(object):
+    """
+    Replaces failed readings of each channel by its last good Sample, until tolerance
+    consecutive failures or timeout seconds (0 to disable) since the first of them.
+    The timeout is also checked by expire, so held samples do not outlive it when no
+    more replies arrive.
+    """
+
+    def __init__(self,tolerance=3,timeout=10.):
+        self.tolerance,self.timeout = tolerance,timeout
+        self.failures = {} #{channel:(consecutive failures,time of the first one,last failed Reading)}
+        self.lock = threading.Lock()
+
+    def filter(self,channel,reading,timestamp,good=None,suspended=False):
+        """
+        Returns the Sample to publish for a new channel reading; good is the last Sample published
+        for the channel. Failures are not filtered if suspended (the controller is no longer polled).
+        """
+        with self.lock:
+            if reading.kind not in FAILURE_KINDS:
+                self.failures.pop(channel,None)
+                return Sample(reading,timestamp)
+            failures,since,last = self.failures.get(channel,(0,timestamp,None))
+            failures+=1
+            self.failures[channel] = (failures,since,reading)
+        #Slow channels may have good samples older than the timeout, so it starts at the first failure
+        if suspended or good is None or good.reading.kind in FAILURE_KINDS or failures>=self.tolerance \
+                or (self.timeout and timestamp-since>=self.timeout):
+            return Sample(reading,timestamp)
+        return good
+
+    def expire(self,samples,now=None):
+        """
+        Returns {channel:Sample} with the last failed reading of the channels whose
+        good Sample in samples has been held for more than timeout seconds.
+        """
+        now = now or time.time()
+        if not self.timeout: return {}
+        with self.lock:
+            return dict((channel,Sample(reading,now)) for channel,(failures,since,reading) in self.failures.items()
+                if now-since>=self.timeout and channel in samples and samples[channel].reading.kind not in FAILURE_KINDS)
@@ -0,0 +1,263 @@
+#=============================================================================
+#
+# file :        MKSProtocol.py
+#
+# description : Parsing of the replies of the MKS 937A Gauge Controller.
+#                It does not depend on PyTango, so it can be used from
+#                scripts and simulators as well as from the device server.
+#
+# project :    VacuumController Device Server
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import re
+from collections import namedtuple
+
+FLOAT = '[0-9](\.[0-9]{1,2})?[eE][+-][0-9]{2,2}$'
+ERROR_CODES = ['PROTECT','HV_OFF','NOGAUGE','MISCONN','LO']
+VALID_CODES = [FLOAT,'HI>','LO','AA_','WAIT','([A-Za-z]+)([ _]?)([A-Z]*)!$']+ERROR_CODES
+
+#Kinds of reading returned by classifyReply
+KINDS = ('INVALID','LO','OFF','PROTECT','NOGAUGE','MISCONN','HI','WAIT','FLOAT','ERROR')
+
+#Quality names are the suffixes of PyTango.AttrQuality.ATTR_*
+QUALITIES = ('VALID','WARNING','ALARM','INVALID')
+
+Reading = namedtuple('Reading','raw kind value quality')
+
+#Readings that are a communication failure rather than a channel state
+FAILURE_KINDS = ('INVALID','ERROR')
+
+#Channel readings published by the polling thread; a Snapshot samples dict
+#is never modified once published, a new Snapshot replaces it instead
+Sample = namedtuple('Sample','reading timestamp')
+Snapshot = namedtuple('Snapshot','generation timestamp samples')
+
+_valid_reply = re.compile('|'.join('(?:%s)'%c for c in VALID_CODES))
+_float_reply = re.compile(FLOAT)
+_exp_number = re.compile('[0-9]+(\.[0-9]*)?[eE][+-]?[0-9]+')
+_tags = re.compile('LO|OFF|PRO|NOGAUGE|MISCONN|HI|WAIT')
+_separators = re.compile('[ ,;]+')
+
+CACHE_SIZE = 1024
+_cache = {}
+
+def parseReply(raw):
+    """ Classifies a raw 937A reply, use classifyReply instead to get cached results """
+    if not raw or not _valid_reply.match(raw):
+        return Reading(raw,'INVALID',None,'INVALID')
+    tags = set(_tags.findall(raw))
+    if 'LO' in tags:
+        return Reading(raw,'LO',0.,'WARNING')
+    if 'OFF' in tags:
+        return Reading(raw,'OFF',0.,'WARNING')
+    if 'PRO' in tags:
+        return Reading(raw,'PROTECT',1.,'ALARM')
+    for kind in ('NOGAUGE','MISCONN'):
+        if kind in tags:
+            return Reading(raw,kind,None,'INVALID')
+    if _float_reply.match(raw):
+        value = float(raw)
+        #Values without positive exponent must be below 1
+        if '+' not in raw and not 0<value<1:
+            return Reading(raw,'INVALID',None,'INVALID')
+        return Reading(raw,'FLOAT',value,'VALID')
+    if 'HI' in tags:
+        m = _exp_number.search(raw)
+        if m: return Reading(raw,'HI',float(m.group()),'ALARM')
+        return Reading(raw,'HI',None,'INVALID')
+    if 'WAIT' in tags:
+        return Reading(raw,'WAIT',None,'INVALID')
+    return Reading(raw,'ERROR',None,'INVALID')
+
+def classifyReply(raw):
+    """
+    Returns a Reading(raw,kind,value,quality) tuple for a 937A reply.
+    Results are memoized by raw string, the cache is flushed when it reaches CACHE_SIZE.
+    """
+    try:
+        return _cache[raw]
+    except KeyError:
+        reading = parseReply(raw)
+        if len(_cache)>=CACHE_SIZE: _cache.clear()
+        _cache[raw] = reading
+        return reading
+    except TypeError: #Unhashable
+        return parseReply(raw)
+
+def splitReply(raw,n):
+    """
+    Splits the reply of a bulk pressure command in its n channel replies.
+    Returns None if the reply does not contain exactly n fields.
+    """
+    if not raw: return None
+    fields = _separators.split(raw.strip())
+    return fields if len(fields)==n else None
+
+def parseThresholds(config):
+    """
+    Parses a list of 'channel:absolute,relative' lines into a {channel:(absolute,relative)} dict.
+    Channel '*' sets the default thresholds, (0,0) meaning any change.
+    """
+    thresholds = {'*':(0.,0.)}
+    for line in config or []:
+        line = line.split('#',1)[0].strip()
+        if not line: continue
+        channel,values = line.split(':',1) if ':' in line else ('*',line)
+        values = [float(v) for v in values.split(',') if v.strip()]+[0.,0.]
+        thresholds[channel.strip().upper()] = (values[0],values[1])
+    return thresholds
+
+def isChange(previous,reading,absolute=0,relative=0):
+    """ True if reading differs from the previous Reading beyond absolute or relative thresholds """
+    if previous is None or previous.kind!=reading.kind or previous.quality!=reading.quality:
+        return True
+    if reading.value is None or previous.value is None:
+        return False
+    diff = abs(reading.value-previous.value)
+    if not absolute and not relative:
+        return diff>0
+    return bool((absolute and diff>=absolute) or (relative and diff>=relative*abs(previous.value)))
+
+#Channels in these states are polled at the idle period
+IDLE_KINDS = ('OFF','NOGAUGE','MISCONN')
+
+def adaptivePeriod(reading,previous,period,idle,setpoint=None,change=.1):
+    """
+    Returns the polling period for a channel given its last two Readings:
+    idle for channels off, without gauge or stable below range;
+    period/2 if the kind changed, the pressure changed more than change (relative)
+    or it is above half the protect setpoint; period otherwise.
+    """
+    if reading.kind in IDLE_KINDS or (reading.kind=='LO' and previous is not None and previous.kind=='LO'):
+        return max(period,idle)
+    if previous is not None and previous.kind!=reading.kind:
+        return period/2.
+    if reading.value is not None and previous is not None and previous.value:
+        if abs(reading.value-previous.value)>change*abs(previous.value):
+            return period/2.
+    if setpoint and reading.kind=='FLOAT' and reading.value>setpoint/2.:
+        return period/2.
+    return period
+
+#(pressure channels,combination channels) of each controller model; the module slots
+#of MODULE_CHANNELS are the 937A ones, other models need their own layout to be added
+MODELS = {
+    '937A':(5,2),
+    }
+
+def channelTable(model='937A',nchannels=-1,ncombinations=-1):
+    """
+    Returns the (['P1',...],['C1',...]) channel names of a controller;
+    nchannels/ncombinations override the model ones if not negative (e.g. single module units).
+    """
+    channels,combinations = MODELS.get((model or '937A').strip().upper(),MODELS['937A'])
+    if nchannels>=0: channels = nchannels
+    if ncombinations>=0: combinations = ncombinations
+    return ['P%d'%(i+1) for i in range(channels)],['C%d'%(i+1) for i in range(combinations)]
+
+#Module codes returned by the GAUGES command: (name,gauge type,number of channels);
+#all the low vacuum gauges (Pirani, convection, thermocouple, manometer) are of PIRANI type
+MODULES = {
+    'Hc':('HotCathode','CCG',1),
+    'Cc':('ColdCathode','CCG',1),
+    'Pr':('Pirani','PIRANI',2),
+    'Cv':('ConvectionPirani','PIRANI',2),
+    'Tc':('DualThermocouple','PIRANI',2),
+    'Cm':('DualManometer','PIRANI',2),
+    'P1':('SinglePirani','PIRANI',1),
+    'C1':('SingleConvectionPirani','PIRANI',1),
+    'T1':('SingleThermocouple','PIRANI',1),
+    'M1':('SingleManometer','PIRANI',1),
+    'Nc':('NoModule',None,0),
+    'Wc':('WrongModuleConnected',None,0),
+    }
+
+#Channels of each module slot of the GAUGES reply (CC slot, module A, module B)
+MODULE_CHANNELS = (('P1',),('P2','P3'),('P4','P5'))
+
+def describeModules(modules):
+    """ Returns the modules of a GAUGES reply by slot, e.g. 'P1=CC:ColdCathode; P2=A:Pirani; P4=B:Pirani' """
+    names = [MODULES.get(modules[i:i+2],(modules[i:i+2],))[0] for i in (0,2,4)]
+    return 'P1=CC:%s; P2=A:%s; P4=B:%s'%tuple(names)
+
+def moduleChannels(modules):
+    """ Returns {'CCG':[channels],'PIRANI':[channels]} for a GAUGES reply, unknown modules are ignored """
+    channels = {'CCG':[],'PIRANI':[]}
+    for i,slot in enumerate(MODULE_CHANNELS):
+        name,kind,n = MODULES.get((modules or '')[2*i:2*i+2],(None,None,0))
+        if kind: channels[kind].extend(slot[:n])
+    return channels
+
+#Crossover pressure used when the protect setpoint of the cold cathode is not available
+DEFAULT_CROSSOVER = 1e-3
+
+def combinationPairs(modules):
+    """
+    Returns {'C1':(ccg,pirani),'C2':(ccg,pirani)} for a GAUGES reply: cold cathode channels
+    are paired, in order, with the channels of the Pirani modules.
+    """
+    channels = moduleChannels(modules)
+    return dict(('C%d'%(i+1),pair) for i,pair in enumerate(zip(channels['CCG'],channels['PIRANI'])))
+
+def combineReadings(ccg,pirani,crossover=DEFAULT_CROSSOVER):
+    """
+    Combination channel from the cold cathode and Pirani Readings (any of them can be None):
+    the cold cathode is used while the Pirani reads below crossover, the Pirani otherwise
+    or when the cold cathode has no pressure (off, protected, not read).
+    """
+    if ccg is not None and ccg.kind in ('FLOAT','LO'):
+        if pirani is None or pirani.value is None or pirani.value<crossover:
+            return ccg
+    if pirani is not None and pirani.value is not None:
+        return pirani
+    return ccg or pirani or parseReply(None)
+
+#Slow-changing commands whose replies can be cached across restarts
+SETTINGS = ['GAUGES','VER','PRO1','PRO2','RELAYS']+['RLY%d'%i for i in range(1,6)]
+
+def isValidSetting(command,reply):
+    """ Checks the format of the reply to one of the SETTINGS commands """
+    if not reply: return False
+    if command=='GAUGES': return bool(re.match('[A-Za-z0-9]{6}$',reply.strip()))
+    if command=='RELAYS': return bool(re.match('[01]{5}$',reply.strip()[-5:]))
+    if command[:3] in ('PRO','RLY'): return classifyReply(reply).kind=='FLOAT'
+    return classifyReply(reply).kind!='INVALID' or bool(re.match('[\x20-\x7e]+$',reply))
+
+_prefix = re.compile('\$[0-9]+')
+
+def isValidReply(comm,reply):
+    """ False if the reply to a (maybe prefixed) command is garbled or not the expected one """
+    if not reply: return False
+    command = _prefix.sub('',comm,1).strip().upper()
+    if command[:1] in ('P','C') and command[1:].isdigit():
+        return classifyReply(reply).kind!='INVALID'
+    if command in SETTINGS:
+        return isValidSetting(command,reply)
+    return bool(re.match('[\x20-\x7e]+$',reply))
+
+def percentile(values,p):
+    """ Returns the p (0-100) percentile of a list of values, None if empty """
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values)-1,int(round(p/100.*(len(values)-1))))]
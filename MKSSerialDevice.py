@@ -0,0 +1,639 @@
+#=============================================================================
+#
+# file :        MKSSerialDevice.py
+#
+# description : Polling of MKS 937A serial lines, through a SerialVacuumDevice
+#                or a direct MKSTransport, used by MKSGaugeController.
+#
+# project :    VacuumController Device Server
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import time,threading,heapq,itertools,collections
+
+from fandango.log import Logger
+
+from MKSProtocol import splitReply,isValidReply,percentile
+
+class CommFuture(object):
+    """ Reply of a command queued in MKSSerialDevice, commands cancelled before being sent are skipped """
+
+    def __init__(self,comm):
+        self.comm,self.result,self.exception = comm,None,None
+        self.started,self.cancelled = False,False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def start(self):
+        """ Called just before sending the command, returns False if it has been cancelled """
+        with self.lock:
+            if not self.cancelled: self.started = True
+            return self.started
+
+    def cancel(self):
+        """ The command will not be sent; returns False if it is already being sent """
+        with self.lock:
+            if not self.started: self.cancelled = True
+            return self.cancelled
+
+    def set(self,result=None,exception=None):
+        self.result,self.exception = result,exception
+        self.done.set()
+
+    def get(self,timeout=None):
+        """ Waits for the reply; if not sent after timeout seconds the command is cancelled """
+        self.done.wait(timeout)
+        if not self.done.isSet():
+            if self.cancel():
+                raise Exception('MKS_CommTimeout: %s not sent after %s seconds, cancelled'%(self.comm,timeout))
+            self.done.wait() #Already being sent, the reply is not lost
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+class MKSSerialDevice(Logger):
+    """
+    Polls the commands of several controllers sharing a SerialLine.
+
+    Each controller (owner) registers its own polled commands, including its address prefix.
+    The commands due are executed by the process PollScheduler, earliest deadline first, so
+    no controller can starve the others; slow commands are placed in the gaps between fast ones. Replies are cached in readList and served by getComm.
+
+    Commands that are not polled (writes) are sent with submit(); they are kept in a priority
+    queue that the polling thread drains between polled commands, so polling is never stopped.
+
+    When a bulk command is configured getComm serves the channel commands from the
+    last bulk reply; channel commands are still polled at a slow period, their replies are served
+    only until the next bulk reply, and are polled at their own periods if the firmware does not
+    support the bulk command.
+
+    Commands are sent by the line object, a SerialVacuumDevice using the SerialLine device or,
+    if a transport is given, a direct connection (see MKSTransport); both provide serialComm(comm).
+    """
+
+    #Number of consecutive unsplittable bulk replies before falling back to channel commands
+    BULK_MAX_ERRORS = 3
+    #Maximum time to sleep between checks of the polling table
+    MAX_SLEEP = .5
+    #Default time to wait for the reply of a queued command, below the default Tango client timeout (3 s)
+    QUEUE_TIMEOUT = 2.
+    #Number of latencies and polling intervals kept per command for statistics
+    STATS_SIZE = 256
+    #Commands with periods SLOW_RATIO times the fastest one are sent only in the gaps between fast commands
+    SLOW_RATIO = 10
+    #Fast commands missing this fraction of their period are counted as missed deadlines
+    DEADLINE = .5
+    #Consecutive failures of an owner that stop its polling; it is then probed with a single
+    #command, waiting from BACKOFF_MIN to BACKOFF_MAX seconds (doubled on each failure)
+    BREAKER_FAILURES = 5
+    BACKOFF_MIN,BACKOFF_MAX = 1.,60.
+
+    def __init__(self,tangoDevice,period=.1,wait=.1,retries=3,log='INFO',transport=None):
+        """
+        transport: optional tcp://host:port or /dev/tty url, or any object providing serialComm(comm)
+        (e.g. MKSSimulator.MKSLineSimulator), used instead of the tangoDevice SerialLine
+        """
+        Logger.__init__(self,'MKSSerialDevice(%s)'%tangoDevice,level=log)
+        if not transport:
+            from VacuumController import SerialVacuumDevice
+            #Retries are done by serialComm, so they can be counted
+            self.line = SerialVacuumDevice(tangoDevice=tangoDevice,period=period,wait=wait,retries=1,log=log)
+        elif hasattr(transport,'serialComm'):
+            self.line = transport
+        else:
+            from MKSTransport import openTransport
+            self.line = openTransport(transport,timeout=max(.5,wait))
+        self.period,self.wait = period,wait
+        self.commRetries = max(1,retries)
+        self.stats = {} #{comm:{'count','timeouts','retries','invalid','latencies','intervals','last'}}
+        self.serialLine = tangoDevice
+        self.tableLock,self.busLock = threading.RLock(),threading.RLock()
+        self.polled = {} #{comm:{'period','next','owner','reads'}}
+        self.readList = {} #{comm:last reply}
+        self.owners = {} #{owner:{'comms':[],'errors','lasttime','generation','backoff','probe'}}
+        self.init,self.errors,self.lasttime = False,0,0
+        self.bulks,self.bulkChannels = {},{}
+        self.listeners = {} #{owner:[callback]}
+        self.stale = set() #Commands served from a cache until actually read
+        self.queue,self.counter = [],itertools.count()
+        self.Alive = False
+
+    ###########################################################################
+    # Polling table
+
+    def attach(self,owner):
+        with self.tableLock:
+            self.owners.setdefault(owner,{'comms':[],'errors':0,'lasttime':0,'generation':0,'backoff':0,'probe':0})
+
+    def detach(self,owner):
+        """ Removes all the commands polled for owner """
+        with self.tableLock:
+            self.listeners.pop(owner,None)
+            for comm in self.owners.pop(owner,{'comms':[]})['comms']:
+                if not any(comm in o['comms'] for o in self.owners.values()):
+                    self.polled.pop(comm,None)
+                    self.readList.pop(comm,None)
+                    self.bulks.pop(comm,None)
+                    self.bulkChannels.pop(comm,None)
+
+    def setPolledComm(self,comm,period,first=None,owner=''):
+        with self.tableLock:
+            self.attach(owner)
+            if comm not in self.owners[owner]['comms']:
+                self.owners[owner]['comms'].append(comm)
+            entry = self.polled.get(comm)
+            if entry is None:
+                self.polled[comm] = {'period':period,'next':first or time.time(),'owner':owner,'reads':0}
+                self.readList.setdefault(comm,None)
+                self.init = False
+            else:
+                entry['period'] = period
+                if first: entry['next'] = first
+
+    def getPeriod(self,comm):
+        entry = self.polled.get(comm)
+        return entry and entry['period']
+
+    def getComms(self,owner=None):
+        return list(self.polled) if owner is None else list(self.owners.get(owner,{'comms':[]})['comms'])
+
+    def getErrors(self,owner=None):
+        """ Consecutive communication failures """
+        return self.errors if owner is None else self.owners.get(owner,{'errors':0})['errors']
+
+    def getLastTime(self,owner=None):
+        """ Time of the last successful communication """
+        return self.lasttime if owner is None else self.owners.get(owner,{'lasttime':0})['lasttime']
+
+    def getGeneration(self,owner):
+        """ Counter increased every time a reply or the communication status of owner commands changes """
+        return self.owners.get(owner,{'generation':0})['generation']
+
+    def isInit(self,owner=None,comms=None):
+        """ True once all the polled commands (of owner, or just comms) have been read at least once """
+        if owner is None and comms is None: return self.init
+        return all(self.polled[c]['reads'] for c in (comms or self.getComms(owner)) if c in self.polled)
+
+    def isOpen(self,owner):
+        """ True if the polling of owner is suspended after BREAKER_FAILURES consecutive failures """
+        return bool(self.owners.get(owner,{'backoff':0})['backoff'])
+
+    def getProbeTime(self,owner):
+        """ Time at which a suspended owner will be tried again """
+        return self.owners.get(owner,{'probe':0})['probe']
+
+    def getReport(self,owner=None):
+        comms = self.getComms(owner)
+        stale = len(self.stale.intersection(comms))
+        return '%s: %d commands polled, %d errors, last communication at %s%s%s'%(
+            self.serialLine,len(comms),self.getErrors(owner),time.ctime(self.getLastTime(owner)),
+            ', %d cached values not yet revalidated'%stale if stale else '',
+            ', polling suspended until %s'%time.ctime(self.getProbeTime(owner)) if self.isOpen(owner) else '')
+
+    def preloadComm(self,comm,value):
+        """ value will be served for comm (marked as stale) until comm is actually read """
+        with self.tableLock:
+            if self.readList.get(comm) is None:
+                self.readList[comm] = value
+                self.stale.add(comm)
+
+    def isStale(self,comm):
+        return comm in self.stale
+
+    def getDeadline(self,entry,fastest):
+        """ Commands must be sent before their next release (slow ones) or within DEADLINE periods (fast ones) """
+        if entry['period']>=self.SLOW_RATIO*fastest:
+            return entry['next']+entry['period']
+        return entry['next']+self.DEADLINE*entry['period']
+
+    def nextComm(self,now):
+        """
+        Returns (comm,None) for the next command to send, (None,time) with the time to check again otherwise.
+        Due commands are sent earliest deadline first; slow commands are sent only if they fit
+        in the gap before the next fast command is due, once their deadline has passed or,
+        to be read early after start, if they have never been sent (their latency is not known).
+        """
+        with self.tableLock:
+            if not self.polled: return None,now+self.MAX_SLEEP
+            fastest = min(e['period'] for e in self.polled.values())
+            fast,slow,first,gap = [],[],now+self.MAX_SLEEP,now+self.MAX_SLEEP
+            for comm,entry in self.polled.items():
+                isfast = entry['period']<self.SLOW_RATIO*fastest
+                o = self.owners.get(entry['owner'])
+                if o and o['backoff'] and o['probe']>now:
+                    first = min(first,o['probe']) #Suspended owner
+                elif entry['next']>now:
+                    first = min(first,entry['next'])
+                    if isfast: gap = min(gap,entry['next'])
+                else:
+                    (fast if isfast else slow).append((self.getDeadline(entry,fastest),comm))
+            if fast:
+                return min(fast)[1],None
+            if slow:
+                deadline,comm = min(slow)
+                if now+self.getLatency(comm)<=gap or deadline<=now or not self.polled[comm]['reads']:
+                    return comm,None
+                return None,gap
+            return None,first
+
+    def getLatency(self,comm):
+        """ Expected duration of comm, from its last replies """
+        latency = self.getStats(comm)['latency']
+        return latency if latency is not None else self.wait
+
+    def pollNext(self):
+        """ Executes the next due command, if any; returns the time at which next command will be due """
+        sent = self.sendQueued(1)
+        now = time.time()
+        comm,t = self.nextComm(now)
+        if comm is None: return now if sent else t
+        with self.tableLock:
+            entry = self.polled[comm]
+            fastest = min(e['period'] for e in self.polled.values())
+            if now>self.getDeadline(entry,fastest) and not self.isOpen(entry['owner']):
+                self.getStats(comm)['missed']+=1
+            #Releases keep their phase unless the command is late by a whole period
+            entry['next'] = entry['next']+entry['period'] if entry['next']+entry['period']>now else now+entry['period']
+        self.pollComm(comm,entry['owner'])
+        return now
+
+    def pollComm(self,comm,owner=''):
+        stats,now = self.getStats(comm),time.time()
+        if stats['last']: stats['intervals'].append(now-stats['last'])
+        stats['last'] = now
+        try:
+            #Suspended owners are probed without retries
+            result = self.serialComm(comm,retries=1) if self.isOpen(owner) else self.serialComm(comm)
+        except Exception as e:
+            self.warning('%s failed: %s'%(comm,e))
+            result = None
+        with self.tableLock:
+            previous = self.readList.get(comm)
+            if result or comm not in self.stale:
+                self.readList[comm] = result
+                self.stale.discard(comm)
+            if comm in self.polled:
+                self.polled[comm]['reads']+=1
+            #Failures of a bulk command not yet replied are counted for its fallback, not for the breaker
+            pending = comm in self.bulks and self.updateBulkFields(comm,result)
+            o = self.owners.get(owner)
+            suspended = False
+            if o and (result!=previous or not result or o['errors']):
+                o['generation']+=1
+            if result:
+                self.errors,self.lasttime = 0,time.time()
+                if o: o['errors'],o['lasttime'] = 0,self.lasttime
+                if o and o['backoff']:
+                    self.info('%s: %s replied, polling resumed'%(self.serialLine,owner))
+                    o['backoff'] = 0
+            elif not pending:
+                self.errors+=1
+                if o: o['errors']+=1
+                if o and (o['backoff'] or o['errors']>=self.BREAKER_FAILURES):
+                    suspended = not o['backoff']
+                    o['backoff'] = min(2*o['backoff'],self.BACKOFF_MAX) if o['backoff'] else self.BACKOFF_MIN
+                    o['probe'] = time.time()+o['backoff']
+                    self.warning('%s: %s not replying, polling suspended for %s seconds'%(self.serialLine,owner,o['backoff']))
+            if not self.init:
+                self.init = all(e['reads'] for e in self.polled.values())
+        self.notify(comm,time.time())
+        if suspended:
+            #Replies polled before the failures are no longer valid
+            self.notifyFailure(owner,time.time())
+        return result
+
+    def addListener(self,owner,callback):
+        """ callback(comm,reply,timestamp) will be called from the polling thread for every new reply of owner commands """
+        with self.tableLock:
+            self.listeners.setdefault(owner,[]).append(callback)
+
+    def notify(self,comm,timestamp):
+        comms = [comm]
+        if comm in self.bulks:
+            comms.extend(c for c,p in self.bulks[comm]['channels'])
+        for owner in list(self.listeners):
+            owned = self.owners.get(owner,{'comms':()})['comms']
+            self.callListeners(owner,[(c,self.getComm(c)) for c in comms if c in owned],timestamp)
+
+    def notifyFailure(self,owner,timestamp):
+        """ Notifies a missing reply for every command of owner, called when its polling is suspended """
+        self.callListeners(owner,[(c,None) for c in self.getComms(owner)],timestamp)
+
+    def callListeners(self,owner,replies,timestamp):
+        for callback in list(self.listeners.get(owner,())):
+            for comm,reply in replies:
+                try:
+                    callback(comm,reply,timestamp)
+                except Exception as e:
+                    self.warning('%s listener failed: %s'%(owner,e))
+
+    ###########################################################################
+    # Queued commands
+
+    def submit(self,comm,priority=0,wait=True,timeout=None):
+        """
+        Queues a command to be sent by the polling thread between polled commands.
+        Lower priority values are sent first, same priorities are sent in order.
+        Returns the reply, or a CommFuture if wait is False; commands not sent within timeout are cancelled.
+        """
+        future = CommFuture(comm)
+        with self.tableLock:
+            heapq.heappush(self.queue,(priority,next(self.counter),future))
+        if self.Alive:
+            getScheduler().wake(self)
+        else:
+            self.sendQueued()
+        return future.get(timeout or self.QUEUE_TIMEOUT) if wait else future
+
+    def sendQueued(self,n=None):
+        """ Sends up to n queued commands (all if None), returns the number of commands sent """
+        sent = 0
+        while n is None or sent<n:
+            with self.tableLock:
+                if not self.queue: break
+                future = heapq.heappop(self.queue)[-1]
+            if not future.start(): continue #Cancelled by a caller that timed out
+            try:
+                future.set(self.serialComm(future.comm))
+            except Exception as e:
+                future.set(exception=e)
+            sent+=1
+            #Setpoints written are read back as soon as possible
+            comm = future.comm.split('=',1)[0]
+            with self.tableLock:
+                if '=' in future.comm and comm in self.polled:
+                    self.polled[comm]['next'] = time.time()
+        return sent
+
+    def serialComm(self,comm,retries=None):
+        """ Sends comm through the line, retrying up to commRetries times (or retries) if there is no valid reply """
+        retries = retries or self.commRetries
+        with self.busLock:
+            stats = self.getStats(comm)
+            for i in range(retries):
+                if i: stats['retries']+=1
+                t0 = time.time()
+                try:
+                    reply = self.line.serialComm(comm)
+                except Exception:
+                    if i+1<retries: continue
+                    stats['timeouts']+=1
+                    raise
+                finally:
+                    stats['count']+=1
+                    stats['latencies'].append(time.time()-t0)
+                    stats['latency'] = stats['latencies'][-1] if stats['latency'] is None else .8*stats['latency']+.2*stats['latencies'][-1]
+                if not reply:
+                    stats['timeouts']+=1
+                elif not isValidReply(comm,reply):
+                    stats['invalid']+=1
+                else:
+                    break
+            return reply
+
+    def getStats(self,comm):
+        stats = self.stats.get(comm)
+        if stats is None:
+            stats = self.stats[comm] = {'count':0,'timeouts':0,'retries':0,'invalid':0,'missed':0,'last':0,'latency':None,
+                'latencies':collections.deque(maxlen=self.STATS_SIZE),'intervals':collections.deque(maxlen=self.STATS_SIZE)}
+        return stats
+
+    def getCommStats(self,owner=None):
+        """
+        Returns {comm:{count,timeouts,retries,invalid,missed,p50,p95,p99,period,achieved}} for owner commands;
+        latency percentiles and achieved (average) polling period are in seconds.
+        """
+        result = {}
+        for comm in self.getComms(owner):
+            stats = self.getStats(comm)
+            latencies,intervals = list(stats['latencies']),list(stats['intervals'])
+            result[comm] = dict((k,stats[k]) for k in ('count','timeouts','retries','invalid','missed'))
+            for p in (50,95,99):
+                result[comm]['p%d'%p] = percentile(latencies,p)
+            result[comm]['period'] = self.getPeriod(comm)
+            result[comm]['achieved'] = sum(intervals)/len(intervals) if intervals else None
+        return result
+
+    ###########################################################################
+    # Polling, done by the workers of the process PollScheduler
+
+    def start(self):
+        with self.tableLock:
+            if self.Alive: return
+            self.Alive = True
+        getScheduler().add(self)
+
+    def stop(self):
+        self.Alive = False
+        getScheduler().remove(self)
+        self.sendQueued() #Pending commands are not left waiting
+
+    ###########################################################################
+    # Bulk commands
+
+    def setBulkComm(self,comm,channels,period,slow=None,owner=''):
+        """
+        comm will be polled every period seconds and its reply split between channels.
+        channels is a list of (command,period) tuples, the periods to be used on fallback.
+        """
+        with self.tableLock:
+            self.bulks[comm] = {'channels':list(channels),'errors':0,'supported':False,'fields':{}}
+            for c,p in channels:
+                self.bulkChannels[c] = comm
+            self.setPolledComm(comm,period,owner=owner)
+            for c,p in channels:
+                self.setPolledComm(c,slow or max(p,period)*20,owner=owner)
+
+    def fallbackBulkComm(self,comm):
+        """ Bulk command is not supported, it is no longer polled and channel commands are polled at their own periods """
+        with self.tableLock:
+            bulk = self.bulks.pop(comm,None)
+            if bulk:
+                self.warning('%s not supported, polling channels separately'%comm)
+                entry = self.polled.pop(comm,None)
+                self.readList.pop(comm,None)
+                if entry and comm in self.owners.get(entry['owner'],{'comms':()})['comms']:
+                    self.owners[entry['owner']]['comms'].remove(comm)
+                for c,p in bulk['channels']:
+                    self.bulkChannels.pop(c,None)
+                    self.setPolledComm(c,p,owner=self.polled[c]['owner'])
+
+    def updateBulkFields(self,comm,raw):
+        """
+        Splits a new reply of a bulk command between its channels, called by pollComm.
+        Unsplittable or missing replies are counted and after BULK_MAX_ERRORS consecutive ones
+        the channel commands are polled instead; returns True for the failures counted this way.
+        Once the command has been replied properly, missing replies are communication failures.
+        """
+        bulk = self.bulks[comm]
+        fields = splitReply(raw,len(bulk['channels']))
+        if fields is not None:
+            bulk['errors'],bulk['supported'] = 0,True
+            bulk['fields'] = dict((c[0],f) for c,f in zip(bulk['channels'],fields))
+            return False
+        bulk['fields'] = {}
+        if not raw and bulk['supported']:
+            return False
+        bulk['errors']+=1
+        if bulk['errors']>=self.BULK_MAX_ERRORS:
+            self.fallbackBulkComm(comm)
+        return True
+
+    def getBulkFields(self,comm):
+        """ Returns the {command:reply} dict of the last bulk reply, empty if it failed """
+        bulk = self.bulks.get(comm)
+        return bulk['fields'] if bulk else {}
+
+    def getComm(self,comm):
+        """
+        Returns the last reply of comm; channels of a bulk command are served from the last bulk reply
+        (None or the garbled field if it failed) unless the channel command has been read after it.
+        """
+        bulk = self.bulkChannels.get(comm)
+        if bulk and self.getStats(comm)['last']<=self.getStats(bulk)['last']:
+            return self.getBulkFields(bulk).get(comm)
+        return self.readList.get(comm)
+
+###############################################################################
+# SerialLines shared between devices
+
+_buses,_buses_lock = {},threading.Lock()
+
+def getSerialBus(serialLine,owner,**kwargs):
+    """
+    Returns the MKSSerialDevice used by all the devices of this process connected to serialLine.
+    kwargs are passed to the MKSSerialDevice constructor when the line is opened by first time.
+    """
+    with _buses_lock:
+        bus = _buses.get(serialLine.lower())
+        if bus is None:
+            bus = _buses[serialLine.lower()] = MKSSerialDevice(serialLine,**kwargs)
+        bus.attach(owner)
+    return bus
+
+def releaseSerialBus(bus,owner):
+    """ Removes owner commands from the line, polling is stopped when no device uses it """
+    with _buses_lock:
+        bus.detach(owner)
+        if not bus.owners:
+            bus.stop()
+            if _buses.get(bus.serialLine.lower()) is bus:
+                _buses.pop(bus.serialLine.lower())
+
+###############################################################################
+# Polling workers shared by all the lines of the process
+
+class PollScheduler(object):
+    """
+    Pool of worker threads executing the polling of all the MKSSerialDevice buses of the process.
+    Buses are kept in a heap by the time their next command is due; a bus is taken
+    by a single worker at a time, so commands of a line are never sent concurrently.
+    Workers are created on demand, up to size (and never more than buses).
+    """
+
+    def __init__(self,size=4):
+        self.size = max(1,int(size))
+        self.heap,self.due,self.running,self.woken = [],{},set(),set()
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.workers = []
+
+    def schedule(self,bus,t):
+        entry = (t,next(self.counter),bus)
+        self.due[bus] = entry
+        heapq.heappush(self.heap,entry)
+        self.condition.notify()
+
+    def add(self,bus):
+        with self.condition:
+            if bus not in self.due and bus not in self.running:
+                self.schedule(bus,time.time())
+            while len(self.workers)<min(self.size,len(self.due)+len(self.running)):
+                worker = threading.Thread(target=self.work,name='MKSPollScheduler-%d'%len(self.workers))
+                worker.setDaemon(True)
+                self.workers.append(worker)
+                worker.start()
+
+    def remove(self,bus):
+        """ Removes bus, waiting for the worker that may be polling it """
+        with self.condition:
+            self.due.pop(bus,None)
+            self.woken.discard(bus)
+            while bus in self.running and threading.currentThread() not in self.workers:
+                self.condition.wait(1.)
+
+    def wake(self,bus):
+        """ Polls bus as soon as possible, e.g. when a command has been queued """
+        with self.condition:
+            if bus in self.running:
+                self.woken.add(bus)
+            elif bus in self.due and self.due[bus][0]>time.time():
+                self.schedule(bus,time.time())
+
+    def next(self):
+        """ Waits for the first due bus and marks it as running """
+        with self.condition:
+            while True:
+                #Entries of removed or rescheduled buses are discarded
+                while self.heap and self.due.get(self.heap[0][2]) is not self.heap[0]:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                t,i,bus = self.heap[0]
+                now = time.time()
+                if t>now:
+                    self.condition.wait(t-now)
+                    continue
+                heapq.heappop(self.heap)
+                del self.due[bus]
+                self.running.add(bus)
+                return bus
+
+    def work(self):
+        while True:
+            bus = self.next()
+            try:
+                t = bus.pollNext()
+            except Exception as e:
+                bus.error('MKSSerialDevice.pollNext(%s): %s'%(bus.serialLine,e))
+                t = time.time()+bus.MAX_SLEEP
+            with self.condition:
+                self.running.discard(bus)
+                if bus in self.woken:
+                    self.woken.discard(bus)
+                    t = time.time()
+                if bus.Alive:
+                    self.schedule(bus,t)
+                self.condition.notify_all()
+
+_scheduler,_scheduler_lock = [],threading.Lock()
+
+def getScheduler(size=None):
+    """ Returns the PollScheduler of the process; size, if given, increases the number of workers """
+    with _scheduler_lock:
+        if not _scheduler:
+            _scheduler.append(PollScheduler(size or 4))
+        elif size:
+            _scheduler[0].size = max(_scheduler[0].size,int(size))
+    return _scheduler[0]
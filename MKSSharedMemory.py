@@ -0,0 +1,146 @@
+#=============================================================================
+#
+# file :        MKSSharedMemory.py
+#
+# description : Export of the last channel readings to a memory mapped file,
+#                so local processes can read them without Tango:
+#
+#                  python MKSSharedMemory.py /dev/shm/mks-ccg01
+#
+#                Layout (little endian):
+#                  header  : magic '937A', version H, channels H, sequence Q,
+#                            generation Q, timestamp d                (32 bytes)
+#                  channel : name 8s, value d, timestamp d, quality B,
+#                            kind B, 6 pad bytes, raw reply 16s       (48 bytes)
+#                Quality and kind are indexes in MKSProtocol QUALITIES and KINDS;
+#                value is NaN when the reading has no value.
+#
+#                The writer increments sequence before and after each update
+#                (seqlock): readers retry while it is odd or if it changed
+#                while they were copying the data.
+#
+# project :    VacuumController Device Server
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import os,sys,time,mmap,struct
+
+from MKSProtocol import KINDS,QUALITIES
+
+MAGIC,VERSION = b'937A',1
+HEADER = struct.Struct('<4sHHQQd')
+CHANNEL = struct.Struct('<8sddBB6x16s')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+
+NaN = float('nan')
+
+class SharedMemoryWriter(object):
+    """ Writes channel Samples (see MKSProtocol.Snapshot) to a memory mapped file """
+
+    def __init__(self,path,channels):
+        self.path,self.channels = path,list(channels)
+        self.sequence = 0
+        size = HEADER.size+CHANNEL.size*len(self.channels)
+        fd = os.open(path,os.O_RDWR|os.O_CREAT,0o644)
+        try:
+            os.ftruncate(fd,size)
+            self.map = mmap.mmap(fd,size)
+        finally:
+            os.close(fd)
+        self.write(0,0,{})
+
+    def close(self):
+        self.map.close()
+
+    def write(self,generation,timestamp,samples):
+        """ Writes {channel:Sample} under the seqlock, missing channels are written as INVALID """
+        records = []
+        for channel in self.channels:
+            sample = samples.get(channel)
+            if sample is None:
+                records.append(CHANNEL.pack(channel.encode('ascii'),NaN,0.,QUALITIES.index('INVALID'),0,b''))
+                continue
+            r,raw = sample.reading,sample.reading.raw or b''
+            if not isinstance(raw,bytes): raw = raw.encode('ascii','replace')
+            records.append(CHANNEL.pack(channel.encode('ascii'),NaN if r.value is None else r.value,
+                sample.timestamp,QUALITIES.index(r.quality),KINDS.index(r.kind),raw[:16]))
+        self.sequence+=1 #odd, update in progress
+        SEQUENCE.pack_into(self.map,SEQUENCE_OFFSET,self.sequence)
+        self.map[HEADER.size:] = b''.join(records)
+        self.sequence+=1
+        self.map[:HEADER.size] = HEADER.pack(MAGIC,VERSION,len(self.channels),self.sequence,generation,timestamp)
+
+class SharedMemoryReader(object):
+    """ Keeps a file written by SharedMemoryWriter mapped, for repeated reads """
+
+    def __init__(self,path):
+        self.path = path
+        with open(path,'rb') as f:
+            self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.map.close()
+
+    def read(self,retries=1000):
+        """
+        Returns (generation,timestamp,{channel:(value,quality,kind,raw,timestamp)});
+        quality and kind are returned as names.
+        """
+        m = self.map
+        for i in range(retries):
+            data = m[:]
+            magic,version,n,sequence,generation,timestamp = HEADER.unpack_from(data)
+            if magic!=MAGIC or version!=VERSION:
+                raise ValueError('%s is not a MKS 937A shared memory file'%self.path)
+            if sequence%2 or SEQUENCE.unpack_from(m,SEQUENCE_OFFSET)[0]!=sequence:
+                continue #Update in progress
+            channels = {}
+            for j in range(n):
+                name,value,t,quality,kind,raw = CHANNEL.unpack_from(data,HEADER.size+j*CHANNEL.size)
+                channels[name.rstrip(b'\0').decode('ascii')] = (value,QUALITIES[quality],KINDS[kind],
+                    raw.rstrip(b'\0').decode('ascii','replace'),t)
+            return generation,timestamp,channels
+        raise IOError('%s is being updated continuously'%self.path)
+
+def readSharedMemory(path):
+    """ Reads a file written by SharedMemoryWriter once, see SharedMemoryReader.read """
+    reader = SharedMemoryReader(path)
+    try:
+        return reader.read()
+    finally:
+        reader.close()
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    if not args:
+        print('Usage: python MKSSharedMemory.py /path/to/file')
+        return 1
+    generation,timestamp,channels = readSharedMemory(args[0])
+    print('generation %d at %s'%(generation,time.ctime(timestamp)))
+    for name,(value,quality,kind,raw,t) in sorted(channels.items()):
+        print('%-4s %-12s %-8s %-8s %s'%(name,raw,kind,quality,time.ctime(t)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+#=============================================================================
+#
+# file :        MKSSimulator.py
+#
+# description : Simulator of MKS 937A Gauge Controllers, it emulates the
+#                subset of the serial protocol used by MKSGaugeController.
+#                It can be used in-process or served on a TCP port like
+#                a terminal server:
+#
+#                  python MKSSimulator.py --port 4001 --address 0 --address 1
+#
+# project :    VacuumController Device Server
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import sys,time,re,random,threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+class MKS937ASimulator(object):
+    """
+    Emulates a single 937A controller: GAUGES, P1-5, C1-2, PRO1-2, RLY1-5, RELAYS, VER, ECC/XCC.
+
+    Slot CC is read as P1, module A as P2/P3 and module B as P4/P5;
+    gauges uses the same two letter codes returned by the GAUGES command.
+    Pressures are changed with setPressure, HV with the ECC/XCC commands.
+    """
+
+    CC_RANGE = (1e-11,1e-2)
+    PIRANI_RANGE = (1e-4,1e3)
+
+    def __init__(self,gauges='CcPrPr',version='SIM937A',bulk=None,
+            again=0.,pending=0.,seed=None):
+        self.gauges,self.version,self.bulk = gauges,version,bulk
+        self.again,self.pending = again,pending
+        self.random = random.Random(seed)
+        self.pressures = dict((i,1e-8 if self.isCC(i) else 1e-3) for i in range(1,6))
+        self.hv = dict((i,True) for i in range(1,6))
+        self.protect = {1:'1.0E-05',2:'1.0E-05'}
+        self.relays = dict((i,'1.0E-06') for i in range(1,6))
+        self.pendingHV = set()
+
+    def module(self,channel):
+        return self.gauges[0:2] if channel==1 else self.gauges[2:4] if channel<4 else self.gauges[4:6]
+
+    def isCC(self,channel):
+        #Cold cathode modules provide a single channel
+        return self.module(channel) in ('Cc','Hc') and channel in (1,2,4)
+
+    def setPressure(self,channel,value):
+        self.pressures[channel] = value
+
+    def readChannel(self,channel):
+        module = self.module(channel)
+        if module in ('Nc','') or (module in ('Cc','Hc') and not self.isCC(channel)):
+            return 'NOGAUGE'
+        if module=='Wc':
+            return 'MISCONN'
+        p = self.pressures[channel]
+        if self.isCC(channel):
+            if not self.hv[channel]: return 'HV_OFF'
+            if p>self.CC_RANGE[1]: return 'PROTECT!'
+            if p<self.CC_RANGE[0]: return 'LO<E-11'
+        else:
+            if p<self.PIRANI_RANGE[0]: return 'LO<E-04'
+            if p>self.PIRANI_RANGE[1]: return 'HI>'
+        return '%1.2E'%p
+
+    def readCombination(self,n):
+        cc,pirani = (1,2) if n==1 else (4,5)
+        r = self.readChannel(cc)
+        return r if re.match('[0-9]',r) and self.pressures[cc]<1e-3 else self.readChannel(pirani)
+
+    def reply(self,command):
+        """ Returns the reply to a command without prefix """
+        command = command.strip().upper()
+        m = re.match('([A-Z]+)([0-9]?)(=(.*))?$',command)
+        if not m: return '?'
+        name,n,value = m.group(1),int(m.group(2) or 0),m.group(4)
+        if self.bulk and command==self.bulk.upper():
+            return ' '.join(self.readChannel(i) for i in range(1,6))
+        if name=='GAUGES': return self.gauges
+        if name=='VER': return self.version
+        if name=='P' and 1<=n<=5: return self.readChannel(n)
+        if name=='C' and n in (1,2): return self.readCombination(n)
+        if name=='RELAYS':
+            return ''.join(str(int(self.pressures[i]<float(self.relays[i]))) for i in range(1,6))
+        if name in ('PRO','RLY'):
+            table = self.protect if name=='PRO' else self.relays
+            if n not in table: return '?'
+            if value is not None:
+                table[n] = '%1.1E'%float(value)
+                return 'OK'
+            return table[n]
+        if name in ('ECC','XCC') and n in self.hv:
+            if name=='XCC':
+                self.hv[n] = False
+                return 'OK'
+            if self.random.random()<self.again: return 'AGAIN'
+            if n not in self.pendingHV and self.random.random()<self.pending:
+                self.pendingHV.add(n)
+                return 'PENDING'
+            self.pendingHV.discard(n)
+            self.hv[n] = True
+            return 'OK'
+        return '?'
+
+class MKSLineSimulator(object):
+    """
+    A serial line with one or several simulated controllers.
+    With a single controller commands without $<address> prefix are accepted;
+    commands to missing addresses are not answered (serialComm returns None).
+    latency and jitter (seconds) are added to every command, errors is the
+    probability of a garbled reply or a timeout.
+    """
+
+    def __init__(self,controllers=None,latency=0.,jitter=0.,errors=0.,seed=None):
+        self.controllers = controllers or {0:MKS937ASimulator(seed=seed)}
+        self.latency,self.jitter,self.errors = latency,jitter,errors
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.log = [] #(time,command) of every command received
+
+    def serialComm(self,command):
+        with self.lock:
+            self.log.append((time.time(),command))
+            delay = self.latency+self.jitter*self.random.random()
+            if delay: time.sleep(delay)
+            if self.errors and self.random.random()<self.errors:
+                return None if self.random.random()<.5 else '#%c~'%self.random.choice('!?$&')
+            m = re.match('\$([0-9]+)(.*)$',command.strip())
+            if m:
+                controller = self.controllers.get(int(m.group(1)))
+                return controller.reply(m.group(2)) if controller else None
+            elif len(self.controllers)==1:
+                return list(self.controllers.values())[0].reply(command)
+            return None
+
+    def getPeriods(self,command):
+        """ Intervals between consecutive receptions of command """
+        times = [t for t,c in self.log if c==command]
+        return [b-a for a,b in zip(times,times[1:])]
+
+    def serve(self,port,host=''):
+        """ Serves the line on a TCP port, commands and replies are terminated by \\r """
+        line = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                buff = b''
+                while True:
+                    data = self.request.recv(1024)
+                    if not data: break
+                    buff+=data.replace(b'\n',b'\r')
+                    while b'\r' in buff:
+                        command,buff = buff.split(b'\r',1)
+                        if not command.strip(): continue
+                        reply = line.serialComm(command.decode('ascii','replace'))
+                        if reply is not None:
+                            self.request.sendall(reply.encode('ascii')+b'\r')
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((host,port),Handler)
+        server.daemon_threads = True
+        return server
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='MKS 937A serial line simulator')
+    parser.add_argument('--port',type=int,default=4001)
+    parser.add_argument('--address',type=int,action='append',help='controller address, can be repeated')
+    parser.add_argument('--gauges',default='CcPrPr')
+    parser.add_argument('--bulk',default=None,help='command name answering all the channels')
+    parser.add_argument('--latency',type=float,default=0.)
+    parser.add_argument('--jitter',type=float,default=0.)
+    parser.add_argument('--errors',type=float,default=0.)
+    parser.add_argument('--again',type=float,default=0.)
+    parser.add_argument('--pending',type=float,default=0.)
+    args = parser.parse_args(args)
+    controllers = dict((a,MKS937ASimulator(args.gauges,bulk=args.bulk,again=args.again,pending=args.pending))
+        for a in (args.address or [0]))
+    line = MKSLineSimulator(controllers,args.latency,args.jitter,args.errors)
+    server = line.serve(args.port)
+    print('MKS 937A simulator serving controllers %s at port %d'%(sorted(controllers),args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
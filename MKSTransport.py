@@ -0,0 +1,171 @@
+#=============================================================================
+#
+# file :        MKSTransport.py
+#
+# description : Direct connections to MKS 937A controllers, used instead of
+#                a SerialLine Tango device to save a CORBA call per command:
+#
+#                  tcp://host:port      raw socket of a terminal server
+#                  /dev/ttyS0[:9600]    local serial port (8N1, no flow control)
+#
+# project :    VacuumController Device Server
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import os,time,select,socket,threading
+
+#Commands and replies are terminated by carriage return
+TERMINATOR = b'\r'
+
+class Transport(object):
+    """
+    Base class of the direct connections, subclasses implement open, close, fileno, send and recv.
+    serialComm(comm) has the same contract as SerialVacuumDevice.serialComm:
+    it returns the reply without terminator or None if there is no reply in timeout seconds.
+    """
+
+    def __init__(self,url,timeout=.5):
+        self.url,self.timeout = url,timeout
+        self.lock = threading.Lock()
+        self.buffer = b''
+
+    def __repr__(self):
+        return '%s(%s)'%(type(self).__name__,self.url)
+
+    def isOpen(self):
+        return self.fileno() is not None
+
+    def readable(self,timeout):
+        return bool(select.select([self.fileno()],[],[],max(0,timeout))[0])
+
+    def flush(self):
+        """ Discards late replies of previous commands """
+        while self.readable(0):
+            if not self.recv(1024): break
+        self.buffer = b''
+
+    def readline(self,timeout):
+        end = time.time()+timeout
+        while TERMINATOR not in self.buffer:
+            if not self.readable(end-time.time()):
+                return None
+            data = self.recv(1024)
+            if not data: #Connection closed by peer
+                raise IOError('%s closed'%self.url)
+            self.buffer+=data.replace(b'\n',TERMINATOR)
+        line,self.buffer = self.buffer.split(TERMINATOR,1)
+        return line
+
+    def serialComm(self,comm):
+        with self.lock:
+            try:
+                if not self.isOpen(): self.open()
+                self.flush()
+                self.send(comm.strip().encode('ascii')+TERMINATOR)
+                #Empty lines left by \r\n terminators are skipped
+                end = time.time()+self.timeout
+                line = b''
+                while not line.strip():
+                    line = self.readline(end-time.time())
+                    if line is None: return None
+                return line.strip().decode('ascii','replace')
+            except (IOError,OSError,socket.error):
+                self.close()
+                raise
+
+class SocketTransport(Transport):
+    """ tcp://host:port, the connection is opened again on the next command after any error """
+
+    def __init__(self,url,timeout=.5):
+        Transport.__init__(self,url,timeout)
+        host,port = url.split('://',1)[-1].rsplit(':',1)
+        self.address,self.socket = (host,int(port)),None
+
+    def open(self):
+        self.socket = socket.create_connection(self.address,max(self.timeout,1.))
+        self.socket.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+    def close(self):
+        if self.socket is not None:
+            try: self.socket.close()
+            except: pass
+        self.socket,self.buffer = None,b''
+
+    def fileno(self):
+        return self.socket and self.socket.fileno()
+
+    def send(self,data):
+        self.socket.sendall(data)
+
+    def recv(self,n):
+        return self.socket.recv(n)
+
+class SerialTransport(Transport):
+    """ /dev/ttyXX[:baudrate], configured in raw mode with termios """
+
+    def __init__(self,url,timeout=.5):
+        Transport.__init__(self,url,timeout)
+        device = url.split('://',1)[-1]
+        if ':' in device:
+            device,baudrate = device.rsplit(':',1)
+        else:
+            baudrate = 9600
+        self.device,self.baudrate,self.fd = device,int(baudrate),None
+
+    def open(self):
+        import termios
+        fd = os.open(self.device,os.O_RDWR|os.O_NOCTTY|os.O_NONBLOCK)
+        try:
+            speed = getattr(termios,'B%d'%self.baudrate)
+            iflag,oflag,cflag,lflag,ispeed,ospeed,cc = termios.tcgetattr(fd)
+            cc[termios.VMIN],cc[termios.VTIME] = 0,0
+            termios.tcsetattr(fd,termios.TCSANOW,
+                [0,0,termios.CS8|termios.CREAD|termios.CLOCAL,0,speed,speed,cc])
+        except Exception:
+            os.close(fd)
+            raise
+        self.fd = fd
+
+    def close(self):
+        if self.fd is not None:
+            try: os.close(self.fd)
+            except: pass
+        self.fd,self.buffer = None,b''
+
+    def fileno(self):
+        return self.fd
+
+    def send(self,data):
+        while data:
+            data = data[os.write(self.fd,data):]
+
+    def recv(self,n):
+        return os.read(self.fd,n)
+
+def openTransport(url,timeout=.5):
+    """ Returns the Transport for a tcp://host:port or /dev/ttyXX[:baudrate] url """
+    if url.lower().startswith('tcp://'):
+        return SocketTransport(url,timeout)
+    if url.lower().startswith('serial://') or url.startswith('/'):
+        return SerialTransport(url,timeout)
+    raise ValueError('Unknown transport: %s'%url)
@@ -0,0 +1,4 @@
+import os,sys
+
+#Modules of the device server are imported from the repository folder
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
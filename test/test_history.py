@@ -0,0 +1,48 @@
+from MKSProtocol import Sample,classifyReply
+from MKSHistory import PressureHistory,MissreadingsFilter,detectNoise
+
+def test_ring_buffer():
+    h = PressureHistory(3)
+    for i in range(5):
+        h.append(i,1e-8*(i+1))
+    times,values,qualities = h.last()
+    assert times==[2.,3.,4.] and len(h)==3
+    assert h.last(1)[0]==[4.]
+
+def test_stats_ignore_nan():
+    h = PressureHistory(10)
+    for t,v in ((1,1e-8),(2,None),(3,2e-8)):
+        h.append(t,v,'VALID' if v else 'WARNING')
+    mn,mx,mean,std,count = h.stats(10,now=3)
+    assert (mn,mx,count)==(1e-8,2e-8,2)
+
+def test_noise():
+    times = list(range(10))
+    assert detectNoise(times,[1e-8]*10).spikes==0
+    assert detectNoise(times,[1e-8,1e-6]*5).spikes>=2
+    assert detectNoise(times,[1e-8*10**(i/10.) for i in times]).slope>0
+
+def test_missreadings_filter_expires_without_replies():
+    f = MissreadingsFilter(tolerance=3,timeout=10.)
+    good = Sample(classifyReply('1.00E-08'),0.)
+    assert f.filter('P1',classifyReply(None),1.,good) is good
+    #No more replies arrive after the first failure
+    assert f.expire({'P1':good},5.)=={}
+    expired = f.expire({'P1':good},11.)
+    assert expired['P1'].reading.kind=='INVALID' and expired['P1'].timestamp==11.
+    assert f.expire({'P1':expired['P1']},12.)=={}
+    #A good reading clears the failures
+    ok = f.filter('P1',classifyReply('2.00E-08'),13.,expired['P1'])
+    assert ok.reading.value==2e-8 and f.expire({'P1':ok},30.)=={}
+
+def test_missreadings_filter_tolerance():
+    f = MissreadingsFilter(tolerance=2,timeout=0)
+    good = Sample(classifyReply('1.00E-08'),0.)
+    assert f.filter('P1',classifyReply('#?'),1.,good) is good
+    assert f.filter('P1',classifyReply('#?'),2.,good).reading.kind=='INVALID'
+    assert f.expire({'P1':good},1e6)=={}
+
+def test_missreadings_filter_suspended():
+    f = MissreadingsFilter(tolerance=3,timeout=10.)
+    good = Sample(classifyReply('1.00E-08'),0.)
+    assert f.filter('P1',classifyReply(None),1.,good,suspended=True).reading.kind=='INVALID'
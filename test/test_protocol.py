@@ -0,0 +1,72 @@
+from MKSProtocol import parseReply,classifyReply,splitReply,isValidReply,isChange,describeModules,moduleChannels,combinationPairs,channelTable
+
+def test_parse_float():
+    r = parseReply('1.20E-07')
+    assert (r.kind,r.value,r.quality)==('FLOAT',1.2e-7,'VALID')
+    assert parseReply('5.00E+02').value==500.
+    #Values without positive exponent must be below 1
+    assert parseReply('5.00E-00').kind=='INVALID'
+
+def test_parse_codes():
+    assert parseReply('LO<E-11')[1:]==('LO',0.,'WARNING')
+    assert parseReply('HV_OFF')[1:]==('OFF',0.,'WARNING')
+    assert parseReply('PROTECT!')[1:]==('PROTECT',1.,'ALARM')
+    assert parseReply('NOGAUGE').kind=='NOGAUGE'
+    assert parseReply('MISCONN').kind=='MISCONN'
+    assert parseReply('WAIT').kind=='WAIT'
+    assert parseReply('HI>').kind=='HI'
+    assert parseReply('CTRL_ERR!')[1:]==('ERROR',None,'INVALID')
+
+def test_parse_invalid():
+    for raw in (None,'','OFF','#!~','1.2E-7x','?'):
+        assert parseReply(raw).kind=='INVALID',raw
+        assert parseReply(raw).value is None
+
+def test_classify_cached():
+    assert classifyReply('1.00E-08') is classifyReply('1.00E-08')
+    assert classifyReply('1.00E-08')==parseReply('1.00E-08')
+
+def test_split():
+    assert splitReply('1.00E-08 1.00E-03,LO<E-04;NOGAUGE  HV_OFF',5)==['1.00E-08','1.00E-03','LO<E-04','NOGAUGE','HV_OFF']
+    assert splitReply(' 1.00E-08 1.00E-03 ',2)==['1.00E-08','1.00E-03']
+    assert splitReply('1.00E-08 1.00E-03',5) is None
+    assert splitReply('?',5) is None
+    assert splitReply(None,5) is None
+    assert splitReply('',5) is None
+
+def test_valid_reply():
+    assert isValidReply('$1P1','1.00E-08')
+    assert not isValidReply('$1P1','#!~')
+    assert isValidReply('GAUGES','CcPrPr')
+    assert not isValidReply('GAUGES','Cc')
+    assert isValidReply('RELAYS','01001')
+    assert not isValidReply('PRO1','LO<E-11')
+    assert not isValidReply('VER',None)
+
+def test_is_change():
+    a,b = parseReply('1.00E-08'),parseReply('1.05E-08')
+    assert isChange(None,a)
+    assert isChange(a,b)
+    assert not isChange(a,b,relative=.1)
+    assert isChange(a,parseReply('LO<E-11'),relative=.1)
+
+def test_describe_modules():
+    assert describeModules('CcPrPr')=='P1=CC:ColdCathode; P2=A:Pirani; P4=B:Pirani'
+    assert describeModules('HcNcXx')=='P1=CC:HotCathode; P2=A:NoModule; P4=B:Xx'
+
+def test_module_channels():
+    assert moduleChannels('CcPrPr')=={'CCG':['P1'],'PIRANI':['P2','P3','P4','P5']}
+    assert moduleChannels('CcCcT1')=={'CCG':['P1','P2'],'PIRANI':['P4']}
+    assert moduleChannels('HcCmNc')=={'CCG':['P1'],'PIRANI':['P2','P3']}
+    assert moduleChannels(None)=={'CCG':[],'PIRANI':[]}
+
+def test_combination_pairs():
+    assert combinationPairs('CcPrPr')=={'C1':('P1','P2')}
+    assert combinationPairs('CcPrCc')=={'C1':('P1','P2'),'C2':('P4','P3')}
+    assert combinationPairs('CcNcNc')=={}
+
+def test_channel_table():
+    assert channelTable('937A')==(['P1','P2','P3','P4','P5'],['C1','C2'])
+    assert channelTable('937A',2,0)==(['P1','P2'],[])
+    #Models without a module slot layout use the 937A channels
+    assert channelTable('937B')==channelTable('937A')
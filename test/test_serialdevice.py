@@ -0,0 +1,159 @@
+import time
+
+import pytest
+
+from MKSSimulator import MKS937ASimulator,MKSLineSimulator
+from MKSSerialDevice import MKSSerialDevice
+
+def getBus(line=None,**kwargs):
+    return MKSSerialDevice('simulator',transport=line or MKSLineSimulator(),log='ERROR',**kwargs)
+
+def test_next_comm_earliest_deadline():
+    bus,now = getBus(),time.time()
+    bus.setPolledComm('P1',1.,now-.1)
+    bus.setPolledComm('P2',.2,now)
+    bus.setPolledComm('P4',1.,now+.5)
+    #P1 deadline is now+.4, P2 is now+.1
+    assert bus.nextComm(now)==('P2',None)
+    bus.polled['P2']['next'] = now+.2
+    assert bus.nextComm(now)==('P1',None)
+    bus.polled['P1']['next'] = now+1.
+    assert bus.nextComm(now)==(None,now+.2)
+
+def test_next_comm_slow_in_gaps():
+    bus,now = getBus(wait=.1),time.time()
+    bus.setPolledComm('P1',1.,now+.5)
+    bus.setPolledComm('VER',20.,now)
+    #The slow command fits before P1 is due
+    assert bus.nextComm(now)==('VER',None)
+    #Commands never sent are read as soon as possible, even if they may not fit
+    bus.polled['P1']['next'] = now+.05
+    assert bus.nextComm(now)==('VER',None)
+    bus.polled['VER']['reads'] = 1
+    assert bus.nextComm(now)==(None,now+.05)
+    #Unless its deadline (next release) has passed
+    bus.polled['VER']['next'] = now-20.
+    assert bus.nextComm(now)==('VER',None)
+
+def test_breaker():
+    line = MKSLineSimulator({1:MKS937ASimulator()})
+    bus = getBus(line,retries=1)
+    bus.setPolledComm('$1P1',.1,owner='ok')
+    bus.setPolledComm('$2P1',.1,owner='dead')
+    for i in range(bus.BREAKER_FAILURES-1):
+        assert bus.pollComm('$2P1','dead') is None
+    assert not bus.isOpen('dead')
+    bus.pollComm('$2P1','dead')
+    assert bus.isOpen('dead') and not bus.isOpen('ok')
+    probe = bus.getProbeTime('dead')
+    assert probe==pytest.approx(time.time()+bus.BACKOFF_MIN,abs=.1)
+    #Suspended commands are not sent until the probe time
+    now = time.time()
+    for entry in bus.polled.values(): entry['next'] = now
+    assert bus.nextComm(now)==('$1P1',None)
+    bus.polled['$1P1']['next'] = now+1.
+    comm,t = bus.nextComm(now)
+    assert comm is None and t<=probe
+    #Backoff is doubled on each failed probe
+    bus.pollComm('$2P1','dead')
+    assert bus.owners['dead']['backoff']==2*bus.BACKOFF_MIN
+    line.controllers[2] = MKS937ASimulator()
+    assert bus.pollComm('$2P1','dead')=='1.00E-08'
+    assert not bus.isOpen('dead') and bus.getErrors('dead')==0
+
+def test_breaker_notifies_all_commands():
+    line = MKSLineSimulator({1:MKS937ASimulator()})
+    bus = getBus(line,retries=1)
+    for c in ('P1','P2','P4'):
+        bus.setPolledComm('$1'+c,.1,owner='dev')
+    replies = []
+    bus.addListener('dev',lambda comm,reply,timestamp:replies.append((comm,reply)))
+    [bus.pollComm('$1'+c,'dev') for c in ('P1','P2','P4')]
+    del line.controllers[1] #Controller stops replying
+    for i in range(bus.BREAKER_FAILURES):
+        bus.pollComm('$1P1','dev')
+    #Channels without failures get a missing reply too, so listeners do not keep the old ones
+    assert bus.isOpen('dev')
+    assert set(c for c,r in replies[-3:] if r is None)==set(['$1P1','$1P2','$1P4'])
+
+@pytest.mark.parametrize('reply',['?',None])
+def test_bulk_fallback(reply):
+    line = MKSLineSimulator()
+    line.controllers[0].reply = lambda command,reply_=line.controllers[0].reply: reply if command=='PZ' else reply_(command)
+    bus = getBus(line,retries=1)
+    bus.setBulkComm('PZ',[('P%d'%i,.1) for i in range(1,6)],.1,owner='dev')
+    assert bus.getPeriod('P1')==pytest.approx(2.)
+    for i in range(bus.BULK_MAX_ERRORS):
+        bus.pollComm('PZ','dev')
+    #Channels are polled at their own period, the bulk command is no longer polled
+    assert 'PZ' not in bus.polled and 'PZ' not in bus.bulks
+    assert bus.getPeriod('P1')==.1
+    assert not bus.isOpen('dev') and bus.getErrors('dev')==0
+
+def test_bulk_fields():
+    bus = getBus(MKSLineSimulator({0:MKS937ASimulator(bulk='PZ')}))
+    bus.setBulkComm('PZ',[('P%d'%i,.1) for i in range(1,6)],.1,owner='dev')
+    bus.pollComm('PZ','dev')
+    assert bus.getComm('P1')=='1.00E-08' and bus.getComm('P5')=='1.00E-03'
+    assert bus.readList['P1'] is None #Served from the bulk reply
+
+def test_bulk_failure_not_served_from_channel():
+    line = MKSLineSimulator({0:MKS937ASimulator(bulk='PZ')})
+    controller = line.controllers[0]
+    bus = getBus(line,retries=1)
+    bus.setBulkComm('PZ',[('P%d'%i,.1) for i in range(1,6)],.1,owner='dev')
+    replies = []
+    bus.addListener('dev',lambda comm,reply,timestamp:replies.append((comm,reply)))
+    bus.pollComm('P1','dev')
+    bus.pollComm('PZ','dev')
+    #The bulk reply fails after the pressure changed, the old P1 reply must not be published
+    controller.setPressure(1,5e-8)
+    controller.bulk = None
+    del replies[:]
+    bus.pollComm('PZ','dev')
+    assert ('P1',None) in replies and bus.getComm('P1') is None
+    #Until P1 itself is read again
+    bus.pollComm('P1','dev')
+    assert replies[-1]==('P1','5.00E-08') and bus.getComm('P1')=='5.00E-08'
+
+def test_cancelled_commands_not_sent():
+    line = MKSLineSimulator()
+    bus = getBus(line)
+    bus.Alive = True #Queued commands are left for the polling thread
+    future = bus.submit('XCC1',wait=False)
+    with pytest.raises(Exception):
+        future.get(.05)
+    assert bus.sendQueued()==0 and not line.log
+    assert bus.submit('VER',wait=False) and bus.sendQueued()==1
+
+def test_scheduler_polling():
+    line = MKSLineSimulator(latency=.005)
+    bus = getBus(line,wait=.01) #Slow commands fit between P1 reads
+    bus.setPolledComm('P1',.05,owner='dev')
+    bus.setPolledComm('VER',1.,owner='dev')
+    replies = []
+    bus.addListener('dev',lambda comm,reply,timestamp:replies.append((comm,reply)))
+    bus.start()
+    try:
+        time.sleep(.5)
+    finally:
+        bus.stop()
+    periods = line.getPeriods('P1')
+    assert sum(periods)/len(periods)==pytest.approx(.05,abs=.01)
+    assert ('VER','SIM937A') in replies
+    assert bus.isInit('dev')
+
+def test_slow_commands_read_early():
+    #Default wait (.1) is not smaller than the gaps between fast commands
+    line = MKSLineSimulator(latency=.002)
+    bus = getBus(line)
+    for i in (1,2,4,5):
+        bus.setPolledComm('P%d'%i,.1,owner='dev')
+    for c in ('GAUGES','P3','VER'):
+        bus.setPolledComm(c,2.,owner='dev')
+    bus.start()
+    try:
+        time.sleep(.5)
+    finally:
+        bus.stop()
+    assert bus.isInit('dev')
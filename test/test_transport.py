@@ -0,0 +1,73 @@
+import os,threading
+
+import pytest
+
+from MKSSimulator import MKS937ASimulator,MKSLineSimulator
+from MKSTransport import openTransport,SocketTransport,SerialTransport
+from MKSSerialDevice import MKSSerialDevice
+
+@pytest.fixture
+def server():
+    line = MKSLineSimulator()
+    server = line.serve(0,'localhost')
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_open_transport():
+    assert isinstance(openTransport('tcp://localhost:4001'),SocketTransport)
+    assert isinstance(openTransport('/dev/ttyS0:19200'),SerialTransport)
+    assert openTransport('/dev/ttyS0:19200').baudrate==19200
+    with pytest.raises(ValueError):
+        openTransport('udp://localhost:4001')
+
+def test_socket(server):
+    transport = openTransport('tcp://localhost:%d'%server.server_address[1],timeout=.2)
+    try:
+        assert transport.serialComm('P1')=='1.00E-08'
+        assert transport.serialComm('GAUGES')=='CcPrPr'
+        assert transport.serialComm('$7P1') is None #Missing address, not replied
+        assert transport.serialComm('VER')=='SIM937A'
+    finally:
+        transport.close()
+
+def test_serial_device_over_socket(server):
+    bus = MKSSerialDevice('tcp://localhost:%d'%server.server_address[1],wait=.2,transport='tcp://localhost:%d'%server.server_address[1])
+    try:
+        assert bus.pollComm('P1','test')=='1.00E-08'
+        assert bus.getComm('P1')=='1.00E-08'
+        assert bus.getStats('P1')['count']==1
+    finally:
+        bus.line.close()
+
+def test_pty():
+    master,slave = os.openpty()
+    controller = MKS937ASimulator()
+    def serve():
+        buff = b''
+        while True:
+            try:
+                data = os.read(master,1024)
+            except OSError:
+                break
+            if not data: break
+            buff+=data
+            while b'\r' in buff:
+                command,buff = buff.split(b'\r',1)
+                os.write(master,controller.reply(command.decode('ascii')).encode('ascii')+b'\r\n')
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    transport = openTransport(os.ttyname(slave),timeout=.5)
+    try:
+        assert transport.serialComm('P2')=='1.00E-03'
+        #\r\n terminators do not leave empty replies for the next command
+        assert transport.serialComm('GAUGES')=='CcPrPr'
+        controller.setPressure(2,2e-3)
+        assert transport.serialComm('P2')=='2.00E-03'
+    finally:
+        transport.close()
+        os.close(slave)
+        os.close(master)